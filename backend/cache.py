@@ -0,0 +1,105 @@
+"""Cache of generated study artifacts, keyed on the document content"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional
+
+from storage import STORAGE_DIR, atomic_write
+
+GENERATION_CACHE_DIR = STORAGE_DIR / "generation_cache"
+GENERATION_CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", str(7 * 24 * 3600)))
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "1000"))
+# Bump when the AI service prompts change so older results are not reused
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "1")
+
+
+def cache_key(endpoint: str, text_hash: str, **params) -> str:
+    """Key for one generation: endpoint, document text, parameters and prompt version"""
+    material = json.dumps(
+        {"endpoint": endpoint, "text_hash": text_hash, "params": params, "prompt_version": PROMPT_VERSION},
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """Size-bounded LRU cache of AI service responses with a TTL
+
+    Every entry is its own file (``<key>.json``), so adding one costs a
+    single small write. Recency is kept in memory and mirrored in the file
+    mtimes, which restore the LRU order after a restart.
+    """
+
+    def __init__(
+        self,
+        directory: Path = GENERATION_CACHE_DIR,
+        ttl: float = GENERATION_CACHE_TTL,
+        max_entries: int = GENERATION_CACHE_MAX_ENTRIES,
+    ):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+        files = sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            self._entries[path.stem] = path.stat().st_mtime
+        self._evict()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self._path(key).unlink(missing_ok=True)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return a cached result, or None if missing or expired"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (IOError, json.JSONDecodeError):
+            self.discard(key)
+            return None
+        if entry.get("expires_at", 0) < time.time():
+            self.discard(key)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get("result")
+
+    def put(self, key: str, result: Any):
+        """Store a result, evicting the least recently used entries"""
+        payload = json.dumps(
+            {"expires_at": time.time() + self.ttl, "result": result}, ensure_ascii=False
+        )
+        try:
+            atomic_write(self._path(key), payload.encode("utf-8"))
+        except (IOError, OSError) as e:
+            print(f"Error writing generation cache entry {key}: {e}")
+            return
+        with self._lock:
+            self._entries[key] = time.time()
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def discard(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        self._path(key).unlink(missing_ok=True)
+
+
+generation_cache = GenerationCache()
@@ -0,0 +1,256 @@
+"""Background ingestion pipeline for uploaded documents"""
+import asyncio
+import os
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+import upstream
+from metrics import INGEST_QUEUE_DEPTH, INGEST_STAGE, request_id
+from singleflight import inflight
+from storage import storage, STORAGE_DIR
+from upstream import DOCUMENT_SERVICE, AI_SERVICE
+
+# Uploads wait here until a worker has extracted them
+UPLOADS_DIR = STORAGE_DIR / "uploads"
+UPLOADS_DIR.mkdir(exist_ok=True)
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "100"))
+
+# Document status values; stage/progress give finer detail while processing
+ACTIVE_STATUSES = ("queued", "processing")
+FINAL_STATUSES = ("completed", "failed")
+
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue cannot take another document"""
+
+
+def upload_path(document_id: str) -> Path:
+    return UPLOADS_DIR / document_id
+
+
+def job_status(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """The progress-related fields of a document record"""
+    return {
+        "id": doc["id"],
+        "job_id": doc.get("job_id", doc["id"]),
+        "status": doc["status"],
+        "stage": doc.get("stage"),
+        "progress": doc.get("progress"),
+        "error": doc.get("error"),
+    }
+
+
+def find_duplicate(file_hash: Optional[str]) -> Optional[Dict[str, Any]]:
+    """A completed document whose uploaded file had the same hash, if any"""
+    if not file_hash:
+        return None
+    for doc in storage.documents.find("file_hash", file_hash):
+        if doc["status"] == "completed" and doc.get("text_hash"):
+            return doc
+    return None
+
+
+def duplicate_fields(source: Dict[str, Any]) -> Dict[str, Any]:
+    """Fields that make a document reuse the extraction of an identical upload
+
+    Duplicates point at the first document of their group through
+    source_document_id, which is also where generated study material is kept.
+    """
+    return {
+        "stage": "done",
+        "progress": 1.0,
+        "file_type": source.get("file_type"),
+        "page_count": source.get("page_count"),
+        "text_hash": source["text_hash"],
+        "text_size": source.get("text_size"),
+        "indexed": source.get("indexed", False),
+        "source_document_id": source.get("source_document_id") or source["id"],
+    }
+
+
+async def iter_file(path: Path, chunk_size: int = upstream.UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Read a file in chunks without blocking the event loop"""
+    with open(path, "rb") as f:
+        while True:
+            chunk = await run_in_threadpool(f.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class IngestionQueue:
+    """Bounded queue of documents drained by a fixed pool of worker tasks
+
+    Each document moves queued -> processing (stage "extracting", then
+    "indexing") -> completed or failed. Every change is saved on the
+    document record and pushed to anyone subscribed to that document.
+    """
+
+    def __init__(self, workers: int = INGEST_WORKERS, maxsize: int = INGEST_QUEUE_SIZE):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._listeners: Dict[str, List[asyncio.Queue]] = {}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"ingest-worker-{i}")
+            for i in range(self.workers)
+        ]
+        self._tasks.append(asyncio.create_task(self._resume(), name="ingest-resume"))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def submit(self, document_id: str):
+        """Queue a document for ingestion"""
+        if self.queue is None:
+            raise QueueFullError("Ingestion queue is not running")
+        try:
+            self.queue.put_nowait(document_id)
+        except asyncio.QueueFull:
+            raise QueueFullError("Ingestion queue is full, try again later")
+
+    async def _resume(self):
+        """Re-queue documents that were still pending when the process stopped"""
+        pending = [doc for status in ACTIVE_STATUSES for doc in storage.documents.find("status", status)]
+        for doc in pending:
+            if upload_path(doc["id"]).exists():
+                self.set_status(doc["id"], "queued", stage="queued", progress=0.0)
+                await self.queue.put(doc["id"])
+            else:
+                self.set_status(doc["id"], "failed", error="Upload was lost before processing")
+
+    def subscribe(self, document_id: str) -> asyncio.Queue:
+        listener: asyncio.Queue = asyncio.Queue()
+        self._listeners.setdefault(document_id, []).append(listener)
+        return listener
+
+    def unsubscribe(self, document_id: str, listener: asyncio.Queue):
+        listeners = self._listeners.get(document_id, [])
+        if listener in listeners:
+            listeners.remove(listener)
+        if not listeners:
+            self._listeners.pop(document_id, None)
+
+    def set_status(self, document_id: str, status: str, **fields):
+        doc = storage.documents.update(document_id, status=status, **fields)
+        if doc is None:
+            return
+        storage.save_documents()
+        event = job_status(doc)
+        for listener in self._listeners.get(document_id, []):
+            listener.put_nowait(event)
+
+    async def _worker(self):
+        while True:
+            document_id = await self.queue.get()
+            # Calls made for this document carry its job id as their request id
+            request_id.set(document_id)
+            try:
+                try:
+                    await self._ingest(document_id)
+                except httpx.HTTPStatusError as e:
+                    self.set_status(document_id, "failed", error=f"Document service error: {e.response.text}")
+                except Exception as e:
+                    print(f"Ingestion of {document_id} failed: {e}")
+                    self.set_status(document_id, "failed", error=str(e))
+                # Completed, failed or deleted. A worker cancelled at shutdown
+                # never gets here, so _resume can queue its upload again
+                upload_path(document_id).unlink(missing_ok=True)
+            finally:
+                self.queue.task_done()
+
+    async def _ingest(self, document_id: str):
+        doc = storage.documents.get(document_id)
+        path = upload_path(document_id)
+        if doc is None:
+            # Deleted while waiting in the queue
+            return
+
+        # An identical file may have finished while this one was queued
+        file_hash = doc.get("file_hash")
+        source = find_duplicate(file_hash)
+        if source is not None:
+            self.set_status(document_id, "completed", **duplicate_fields(source))
+            return
+
+        self.set_status(document_id, "processing", stage="extracting", progress=0.1)
+        if not file_hash:
+            await self._process(document_id, doc, path)
+            return
+
+        # ...or still be in progress on another worker: wait for it rather
+        # than extracting the same file twice
+        source = await inflight.do(
+            ("ingest", file_hash), lambda: self._process(document_id, doc, path)
+        )
+        if source["id"] != document_id:
+            self.set_status(document_id, "completed", **duplicate_fields(source))
+
+    async def _process(self, document_id: str, doc: Dict[str, Any], path: Path) -> Dict[str, Any]:
+        """Extract and index one upload, returning the completed document's fields"""
+        with INGEST_STAGE.labels("extracting").time():
+            response = await upstream.post_file(
+                DOCUMENT_SERVICE, "/process",
+                field="file",
+                filename=doc["filename"],
+                content_type=doc.get("file_type") or "application/octet-stream",
+                chunks=iter_file(path),
+                size=path.stat().st_size,
+            )
+            response.raise_for_status()
+            result = response.json()
+
+        text = result.get("text_content") or ""
+        text_hash, text_size = await run_in_threadpool(storage.blobs.put, text)
+        self.set_status(
+            document_id, "processing",
+            stage="indexing",
+            progress=0.6,
+            file_type=result.get("file_type", doc.get("file_type")),
+            page_count=result.get("page_count"),
+            text_hash=text_hash,
+            text_size=text_size,
+        )
+
+        indexed = True
+        try:
+            with INGEST_STAGE.labels("indexing").time():
+                response = await upstream.post(
+                    AI_SERVICE, "/index",
+                    idempotent=True,
+                    json={"document_id": document_id, "filename": doc["filename"], "text_content": text},
+                )
+                response.raise_for_status()
+        except httpx.HTTPError as e:
+            # The text is usable without retrieval, so this does not fail the document
+            print(f"Indexing of {document_id} failed: {e}")
+            indexed = False
+
+        self.set_status(document_id, "completed", stage="done", progress=1.0, indexed=indexed)
+        return {
+            "id": document_id,
+            "file_type": result.get("file_type", doc.get("file_type")),
+            "page_count": result.get("page_count"),
+            "text_hash": text_hash,
+            "text_size": text_size,
+            "indexed": indexed,
+        }
+
+
+ingestion = IngestionQueue()
+INGEST_QUEUE_DEPTH.set_function(ingestion.depth)
@@ -1,18 +1,48 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
+from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import List, Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+import asyncio
+import csv
+import hashlib
 import httpx
+import json
 import os
+import time
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from datetime import datetime
 import uuid
 from storage import storage
+import upstream
+from upstream import AI_SERVICE
+from jobs import (
+    ingestion, upload_path, job_status, find_duplicate, duplicate_fields,
+    QueueFullError, FINAL_STATUSES,
+)
+from cache import generation_cache, cache_key
+from singleflight import inflight
+import metrics
+from metrics import GENERATION_CACHE, REQUEST_ID_HEADER, REQUEST_LATENCY
 
 load_dotenv()
 
-app = FastAPI(title="StudyBudds API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await upstream.start()
+    await ingestion.start()
+    yield
+    await ingestion.stop()
+    await upstream.close()
+    # Drain the write-behind flusher before the process exits
+    storage.close()
+
+
+app = FastAPI(title="StudyBudds API", version="1.0.0", lifespan=lifespan)
 
 # CORS configuration
 app.add_middleware(
@@ -21,11 +51,51 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", REQUEST_ID_HEADER, "ETag"],
 )
 
-# Service URLs
-DOCUMENT_SERVICE_URL = os.getenv("DOCUMENT_SERVICE_URL", "http://localhost:8001")
-AI_SERVICE_URL = os.getenv("AI_SERVICE_URL", "http://localhost:8002")
+# Responses smaller than this are sent uncompressed
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+
+
+def is_stream_request(scope) -> bool:
+    """SSE and NDJSON endpoints, whose output must reach the client as it is produced"""
+    path = scope["path"]
+    return (
+        path.endswith(("/stream", "/events"))
+        or path == "/ai/batch"
+        or b"format=ndjson" in scope.get("query_string", b"")
+    )
+
+
+class StreamAwareGZipMiddleware:
+    """GZip compression for everything except streaming responses"""
+
+    def __init__(self, app, minimum_size: int = GZIP_MINIMUM_SIZE):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not is_stream_request(scope):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(StreamAwareGZipMiddleware)
+
+# Largest accepted upload; bigger requests are refused before the body is read
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# Allowance for the multipart framing around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+# Pagination for list endpoints
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+STREAM_BATCH_SIZE = 200
+
+# How many AI service calls one batch request may have in flight
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
 
 # Use persistent storage
 documents_db = storage.documents
@@ -42,22 +112,34 @@ class DocumentResponse(BaseModel):
     file_type: str
     upload_date: str
     status: str
+    job_id: Optional[str] = None
+    stage: Optional[str] = None
+    progress: Optional[float] = None
+    error: Optional[str] = None
     text_content: Optional[str] = None
+    text_hash: Optional[str] = None
+    text_size: Optional[int] = None
     page_count: Optional[int] = None
+    indexed: Optional[bool] = None
+    file_hash: Optional[str] = None
+    source_document_id: Optional[str] = None
 
 
 class SummaryRequest(BaseModel):
     document_id: str
     type: str = "lecture"
+    force_refresh: bool = False
 
 
 class FlashcardRequest(BaseModel):
     document_id: str
+    force_refresh: bool = False
 
 
 class QuizRequest(BaseModel):
     document_id: str
     question_count: int = 10
+    force_refresh: bool = False
 
 
 class ChatRequest(BaseModel):
@@ -69,328 +151,920 @@ class StudyPlanRequest(BaseModel):
     document_ids: List[str]
 
 
+class BatchRequest(BaseModel):
+    document_ids: List[str]
+    artifacts: List[Literal["summary", "flashcards", "quiz"]] = ["summary", "flashcards", "quiz"]
+    summary_type: str = "lecture"
+    question_count: int = 10
+    force_refresh: bool = False
+
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject oversized uploads from their Content-Length, before parsing the body"""
+    if request.method == "POST" and request.url.path == "/documents/upload":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"File too large (max {MAX_UPLOAD_BYTES} bytes)"},
+            )
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Tag the request with an id (echoed back and sent upstream) and time it"""
+    rid = metrics.new_request_id(request.headers.get(REQUEST_ID_HEADER))
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers[REQUEST_ID_HEADER] = rid
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        route = metrics.route_template(request)
+        REQUEST_LATENCY.labels(request.method, route, str(status)).observe(elapsed)
+        metrics.log_if_slow(rid, request.method, route, status, elapsed)
+
+
+@app.middleware("http")
+async def propagate_deadline(request: Request, call_next):
+    """Start the request deadline from the client's X-Request-Timeout header
+
+    Calls to the document and AI services are cut short to the time left
+    and pass the remaining budget on in the same header.
+    """
+    upstream.set_deadline(request.headers.get(upstream.DEADLINE_HEADER))
+    return await call_next(request)
+
+
+def ai_service_error(e: httpx.HTTPError) -> HTTPException:
+    """Map a failed AI service call to the error returned to the client"""
+    if isinstance(e, upstream.UpstreamUnavailable):
+        return HTTPException(status_code=503, detail=f"AI service unavailable: {str(e)}")
+    if isinstance(e, httpx.TimeoutException):
+        return HTTPException(status_code=504, detail=f"AI service timed out: {str(e)}")
+    return HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+
+
+class PageParams:
+    """Query parameters shared by the list endpoints
+
+    Without ``limit``/``cursor`` the whole collection is returned (oldest
+    first) as before. With them, records come newest first and the cursor
+    for the following page is sent in the ``X-Next-Cursor`` header.
+    ``format=ndjson`` streams one record per line instead of a JSON array.
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+        format: str = Query("json", pattern="^(json|ndjson)$"),
+    ):
+        self.limit = limit
+        self.cursor = cursor
+        self.format = format
+
+
+def iter_records(collection, field: Optional[str] = None, value=None, oldest_first: bool = False):
+    """Walk a whole collection newest first (or oldest first), one page at a time"""
+    cursor = None
+    while True:
+        records, cursor = collection.page(STREAM_BATCH_SIZE, cursor, field, value, oldest_first)
+        yield from records
+        if not cursor:
+            return
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def sse_event(event: str, data) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the client's If-None-Match already names the current ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or etag.removeprefix("W/") in tags
+
+
+def conditional(request: Request, *collections):
+    """ETag headers for a read of the given collections, and a 304 if the client is up to date
+
+    Returns (headers, not_modified_response_or_None). The check only
+    compares version counters, so nothing is loaded or serialized for a 304.
+    """
+    etag = storage.etag(*collections)
+    # no-cache: browsers may keep the body but must revalidate with If-None-Match
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
+
+
+def list_response(request: Request, collection, page: PageParams, field: Optional[str] = None, value=None):
+    """Render a listing as a full list, a cursor page or an NDJSON stream"""
+    headers, not_modified = conditional(request, collection)
+    if not_modified is not None:
+        return not_modified
+    
+    if page.limit is None and page.cursor is None:
+        if page.format == "ndjson":
+            # Oldest first, the same order as the unpaged JSON list
+            return StreamingResponse(
+                ndjson_lines(iter_records(collection, field, value, oldest_first=True)),
+                media_type="application/x-ndjson",
+                headers=headers,
+            )
+        records = collection.find(field, value) if field is not None else collection.all()
+        return JSONResponse(content=records, headers=headers)
+    
+    try:
+        records, next_cursor = collection.page(
+            page.limit or DEFAULT_PAGE_SIZE, page.cursor, field, value
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if page.format == "ndjson":
+        return StreamingResponse(
+            ndjson_lines(records), media_type="application/x-ndjson", headers=headers
+        )
+    return JSONResponse(content=records, headers=headers)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
+
+
 @app.get("/")
 async def root():
     return {"message": "StudyBudds API", "version": "1.0.0"}
 
 
-@app.post("/documents/upload", response_model=DocumentResponse)
+def spool_chunk(f, file_hash, chunk: bytes):
+    file_hash.update(chunk)
+    f.write(chunk)
+
+
+@app.post("/documents/upload", response_model=DocumentResponse, status_code=202)
 async def upload_document(file: UploadFile = File(...)):
-    """Upload a document for processing"""
+    """Upload a document and queue it for background processing"""
+    size = getattr(file, "size", None)
+    if size is not None and size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_BYTES} bytes)")
+    
+    document_id = str(uuid.uuid4())
+    path = upload_path(document_id)
     try:
-        # Forward to document service
-        async with httpx.AsyncClient() as client:
-            files = {"file": (file.filename, await file.read(), file.content_type)}
-            response = await client.post(
-                f"{DOCUMENT_SERVICE_URL}/process",
-                files=files,
-                timeout=60.0
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            # Store document metadata
-            document = DocumentResponse(
-                id=result.get("id", str(uuid.uuid4())),
-                filename=file.filename,
-                file_type=result.get("file_type", file.content_type),
-                upload_date=datetime.now().isoformat(),
-                status="processing",
-                text_content=result.get("text_content"),
-                page_count=result.get("page_count"),
-            )
-            documents_db.append(document.dict())
+        # Spool the upload to disk chunk by chunk, hashing it on the way;
+        # workers stream it from there
+        written = 0
+        file_hash = hashlib.sha256()
+        with open(path, "wb") as f:
+            async for chunk in upstream.iter_upload(file):
+                written += len(chunk)
+                if written > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_BYTES} bytes)")
+                await run_in_threadpool(spool_chunk, f, file_hash, chunk)
+        
+        document = DocumentResponse(
+            id=document_id,
+            job_id=document_id,
+            filename=file.filename or "upload",
+            file_type=file.content_type or "application/octet-stream",
+            upload_date=datetime.now().isoformat(),
+            status="queued",
+            stage="queued",
+            progress=0.0,
+            file_hash=file_hash.hexdigest(),
+        )
+        
+        # The same file was extracted before: reuse its text instead of queueing
+        source = find_duplicate(document.file_hash)
+        if source is not None:
+            path.unlink(missing_ok=True)
+            document = document.copy(update={**duplicate_fields(source), "status": "completed"})
+            documents_db.append(document.dict(exclude={"text_content"}, exclude_none=True))
             storage.save_documents()
-            
             return document
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Document service error: {str(e)}")
+        
+        documents_db.append(document.dict(exclude={"text_content"}, exclude_none=True))
+        try:
+            ingestion.submit(document_id)
+        except QueueFullError as e:
+            documents_db.delete(document_id)
+            raise HTTPException(status_code=503, detail=str(e))
+        storage.save_documents()
+        
+        return document
+    except HTTPException:
+        path.unlink(missing_ok=True)
+        raise
     except Exception as e:
+        path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 
 @app.get("/documents", response_model=List[DocumentResponse])
-async def get_documents():
-    """Get all uploaded documents"""
-    return documents_db
+async def get_documents(request: Request, page: PageParams = Depends()):
+    """Get metadata of uploaded documents (without their text)"""
+    return list_response(request, documents_db, page)
 
 
 @app.get("/documents/{document_id}", response_model=DocumentResponse)
-async def get_document(document_id: str):
-    """Get a specific document"""
-    doc = next((d for d in documents_db if d["id"] == document_id), None)
+async def get_document(document_id: str, request: Request):
+    """Get a specific document including its text"""
+    headers, not_modified = conditional(request, documents_db)
+    if not_modified is not None:
+        return not_modified
+    doc = documents_db.get(document_id)
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
-    return doc
+    return JSONResponse(content={**doc, "text_content": storage.document_text(doc)}, headers=headers)
+
+
+@app.get("/documents/{document_id}/status")
+async def get_document_status(document_id: str, request: Request):
+    """Poll the processing status of a document"""
+    headers, not_modified = conditional(request, documents_db)
+    if not_modified is not None:
+        return not_modified
+    doc = documents_db.get(document_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return JSONResponse(content=job_status(doc), headers=headers)
+
+
+@app.get("/documents/{document_id}/events")
+async def document_events(document_id: str):
+    """Stream processing status changes of a document as Server-Sent Events"""
+    doc = documents_db.get(document_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    async def events():
+        listener = ingestion.subscribe(document_id)
+        try:
+            status = job_status(documents_db.get(document_id) or doc)
+            yield sse_event("status", status)
+            while status["status"] not in FINAL_STATUSES:
+                try:
+                    status = await asyncio.wait_for(listener.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield sse_event("status", status)
+        finally:
+            ingestion.unsubscribe(document_id, listener)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+def parse_byte_range(range_header: str, size: int) -> Optional[tuple[int, int]]:
+    """Parse a single 'bytes=start-end' range into inclusive offsets"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    if start:
+        first = int(start)
+        last = int(end) if end else size - 1
+    else:
+        # Suffix range: the last N bytes
+        first = max(size - int(end), 0)
+        last = size - 1
+    if first > last or first >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return first, min(last, size - 1)
+
+
+@app.get("/documents/{document_id}/text")
+async def get_document_text(document_id: str, request: Request):
+    """Get the extracted text of a document, honouring byte-range requests"""
+    doc = documents_db.get(document_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if not doc.get("text_hash") or not storage.blobs.exists(doc["text_hash"]):
+        return Response(content=storage.document_text(doc), media_type="text/plain; charset=utf-8")
+    
+    text_hash = doc["text_hash"]
+    # The text never changes for a given hash, so the hash is a strong ETag
+    etag = f'"{text_hash}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    range_header = request.headers.get("range")
+    if range_header:
+        size = storage.blobs.size(text_hash)
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            byte_range = None
+        if byte_range:
+            start, end = byte_range
+            return Response(
+                content=storage.blobs.read_range(text_hash, start, end),
+                status_code=206,
+                media_type="text/plain; charset=utf-8",
+                headers={"Content-Range": f"bytes {start}-{end}/{size}", "Accept-Ranges": "bytes", "ETag": etag},
+            )
+    return FileResponse(
+        storage.blobs.path(text_hash),
+        media_type="text/plain; charset=utf-8",
+        headers={"Accept-Ranges": "bytes", "ETag": etag},
+    )
 
 
 @app.delete("/documents/{document_id}")
 async def delete_document(document_id: str):
     """Delete a document"""
-    global documents_db
-    documents_db = [d for d in documents_db if d["id"] != document_id]
+    storage.delete_document(document_id)
+    upload_path(document_id).unlink(missing_ok=True)
     storage.save_documents()
     return {"message": "Document deleted"}
 
 
-@app.post("/ai/summaries")
-async def create_summary(request: SummaryRequest):
-    """Generate a summary for a document"""
-    doc = next((d for d in documents_db if d["id"] == request.document_id), None)
+def materials_owner(doc: dict) -> str:
+    """Document id that generated study material is stored under
+
+    Duplicate uploads share the material of the first document with the
+    same file rather than getting their own copies.
+    """
+    return doc.get("source_document_id") or doc["id"]
+
+
+def materials_filter(document_id: str) -> str:
+    """Map a document id from a listing filter to its materials owner"""
+    doc = documents_db.get(document_id)
+    return materials_owner(doc) if doc else document_id
+
+
+def completed_document(document_id: str) -> dict:
+    """Fetch a document that is ready for generation, or raise 404/400"""
+    doc = documents_db.get(document_id)
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
     if doc["status"] != "completed":
         raise HTTPException(status_code=400, detail="Document processing not completed")
+    return doc
+
+
+async def ai_generate(endpoint: str, doc: dict, force_refresh: bool = False, **params):
+    """Call an AI service generation endpoint through the generation cache
+
+    Returns the AI service result, its cache key and whether it was a hit.
+    """
+    key = cache_key(endpoint, doc["text_hash"], **params) if doc.get("text_hash") else None
+    if key and not force_refresh:
+        cached = await run_in_threadpool(generation_cache.get, key)
+        GENERATION_CACHE.labels(endpoint, "miss" if cached is None else "hit").inc()
+        if cached is not None:
+            return cached, key, True
     
+    response = await upstream.post(
+        AI_SERVICE, f"/{endpoint}",
+        idempotent=True,
+        json={
+            "document_id": doc["id"],
+            "text_content": storage.document_text(doc),
+            **params,
+        },
+    )
+    response.raise_for_status()
+    result = response.json()
+    if key:
+        await run_in_threadpool(generation_cache.put, key, result)
+    return result, key, False
+
+
+def generated_records(collection, document_id: str, key: Optional[str]) -> List[dict]:
+    """Records already created for a document from the same cached generation
+
+    A force_refresh saves a new generation under the same key; every
+    generation stamps its records with its own generation_id, and only the
+    newest one is returned so older results are not merged in.
+    """
+    if not key:
+        return []
+    records = [r for r in collection.by_document(document_id) if r.get("generation_key") == key]
+    if not records:
+        return []
+    latest = records[-1].get("generation_id")
+    return [r for r in records if r.get("generation_id") == latest]
+
+
+@inflight.coalesce(lambda doc, summary_type, force_refresh=False: ("summaries", materials_owner(doc), summary_type, force_refresh))
+async def generate_summary(doc: dict, summary_type: str, force_refresh: bool = False) -> dict:
+    result, key, cached = await ai_generate("summaries", doc, force_refresh, type=summary_type)
+    existing = generated_records(summaries_db, materials_owner(doc), key) if cached else []
+    if existing:
+        return existing[-1]
+    return record_summary(doc, summary_type, result.get("content", ""), key)
+
+
+def record_summary(doc: dict, summary_type: str, content: str, key: Optional[str]) -> dict:
+    summary = {
+        "id": str(uuid.uuid4()),
+        "document_id": materials_owner(doc),
+        "content": content,
+        "created_at": datetime.now().isoformat(),
+        "type": summary_type,
+        "generation_key": key,
+        "generation_id": str(uuid.uuid4()),
+    }
+    summaries_db.append(summary)
+    storage.save_summaries()
+    return summary
+
+
+@app.post("/ai/summaries")
+async def create_summary(request: SummaryRequest):
+    """Generate a summary for a document"""
+    doc = completed_document(request.document_id)
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{AI_SERVICE_URL}/summaries",
+        return await generate_summary(doc, request.type, request.force_refresh)
+    except httpx.HTTPError as e:
+        raise ai_service_error(e)
+
+
+@app.post("/ai/summaries/stream")
+async def stream_summary(request: SummaryRequest):
+    """Generate a summary, streaming tokens as Server-Sent Events
+
+    Emits ``token`` events with text deltas, then a ``done`` event with the
+    saved summary (or an ``error`` event). Cached summaries are sent as a
+    single token.
+    """
+    doc = completed_document(request.document_id)
+    key = cache_key("summaries", doc["text_hash"], type=request.type) if doc.get("text_hash") else None
+    
+    async def events():
+        if key and not request.force_refresh:
+            cached = await run_in_threadpool(generation_cache.get, key)
+            if cached is not None:
+                existing = generated_records(summaries_db, materials_owner(doc), key)
+                summary = existing[-1] if existing else record_summary(
+                    doc, request.type, cached.get("content", ""), key
+                )
+                yield sse_event("token", {"delta": summary["content"]})
+                yield sse_event("done", summary)
+                return
+        
+        parts = []
+        try:
+            async for message in upstream.stream_ndjson(
+                AI_SERVICE, "/summaries/stream",
                 json={
-                    "document_id": request.document_id,
-                    "text_content": doc.get("text_content", ""),
+                    "document_id": doc["id"],
+                    "text_content": storage.document_text(doc),
                     "type": request.type,
                 },
-                timeout=120.0
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            summary = {
-                "id": str(uuid.uuid4()),
-                "document_id": request.document_id,
-                "content": result.get("content", ""),
-                "created_at": datetime.now().isoformat(),
-                "type": request.type,
-            }
-            summaries_db.append(summary)
-            storage.save_summaries()
-            return summary
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+            ):
+                if "delta" in message:
+                    parts.append(message["delta"])
+                    yield sse_event("token", {"delta": message["delta"]})
+                elif "error" in message:
+                    yield sse_event("error", {"detail": message["error"]})
+                    return
+        except httpx.HTTPError as e:
+            yield sse_event("error", {"detail": f"AI service error: {str(e)}"})
+            return
+        
+        content = "".join(parts)
+        if key:
+            await run_in_threadpool(generation_cache.put, key, {"content": content})
+        yield sse_event("done", record_summary(doc, request.type, content, key))
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 
 @app.get("/ai/summaries")
-async def get_summaries(document_id: Optional[str] = None):
+async def get_summaries(request: Request, document_id: Optional[str] = None, page: PageParams = Depends()):
     """Get summaries, optionally filtered by document"""
-    summaries = summaries_db
     if document_id:
-        summaries = [s for s in summaries if s["document_id"] == document_id]
-    return summaries
+        return list_response(request, summaries_db, page, "document_id", materials_filter(document_id))
+    return list_response(request, summaries_db, page)
+
+
+@inflight.coalesce(lambda doc, force_refresh=False: ("flashcards", materials_owner(doc), force_refresh))
+async def generate_flashcards(doc: dict, force_refresh: bool = False) -> List[dict]:
+    result, key, cached = await ai_generate("flashcards", doc, force_refresh)
+    existing = generated_records(flashcards_db, materials_owner(doc), key) if cached else []
+    if existing:
+        return existing
+    
+    flashcards = []
+    generation_id = str(uuid.uuid4())
+    for card in result.get("flashcards", []):
+        card = {
+            **card,
+            "id": str(uuid.uuid4()),
+            "document_id": materials_owner(doc),
+            "created_at": datetime.now().isoformat(),
+            "generation_key": key,
+            "generation_id": generation_id,
+        }
+        flashcards_db.append(card)
+        flashcards.append(card)
+    
+    storage.save_flashcards()
+    return flashcards
 
 
 @app.post("/ai/flashcards")
 async def create_flashcards(request: FlashcardRequest):
     """Generate flashcards for a document"""
-    doc = next((d for d in documents_db if d["id"] == request.document_id), None)
-    if not doc:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    if doc["status"] != "completed":
-        raise HTTPException(status_code=400, detail="Document processing not completed")
-    
+    doc = completed_document(request.document_id)
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{AI_SERVICE_URL}/flashcards",
-                json={
-                    "document_id": request.document_id,
-                    "text_content": doc.get("text_content", ""),
-                },
-                timeout=120.0
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            flashcards = result.get("flashcards", [])
-            for card in flashcards:
-                card["id"] = str(uuid.uuid4())
-                card["document_id"] = request.document_id
-                card["created_at"] = datetime.now().isoformat()
-                flashcards_db.append(card)
-            
-            storage.save_flashcards()
-            return flashcards
+        return await generate_flashcards(doc, request.force_refresh)
     except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+        raise ai_service_error(e)
 
 
 @app.get("/ai/flashcards")
-async def get_flashcards(document_id: Optional[str] = None):
+async def get_flashcards(request: Request, document_id: Optional[str] = None, page: PageParams = Depends()):
     """Get flashcards, optionally filtered by document"""
-    flashcards = flashcards_db
     if document_id:
-        flashcards = [f for f in flashcards if f["document_id"] == document_id]
-    return flashcards
+        return list_response(request, flashcards_db, page, "document_id", materials_filter(document_id))
+    return list_response(request, flashcards_db, page)
+
+
+# Export formats: (delimiter, media type, file extension, header lines)
+EXPORT_FORMATS = {
+    "csv": (",", "text/csv", "csv", ""),
+    "tsv": ("\t", "text/tab-separated-values", "tsv", ""),
+    # Anki's plain-text import reads these file headers, see
+    # https://docs.ankiweb.net/importing/text-files.html#file-headers
+    "anki": ("\t", "text/plain", "txt", "#separator:tab\r\n#html:false\r\n#columns:Front\tBack\r\n"),
+}
+
+
+class RowBuffer:
+    """Write target for csv.writer that hands back what has been written so far"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data: str):
+        self.parts.append(data)
+
+    def take(self) -> str:
+        data = "".join(self.parts)
+        self.parts = []
+        return data
+
+
+def export_rows(document_ids: Optional[List[str]], delimiter: str, header: str):
+    """Yield flashcards as CSV/TSV text, oldest first, one page of cards at a time"""
+    buffer = RowBuffer()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator="\r\n")
+    if header:
+        yield header
+    else:
+        writer.writerow(["Front", "Back"])
+    if document_ids:
+        cards = (
+            card
+            for document_id in dict.fromkeys(materials_filter(d) for d in document_ids)
+            for card in iter_records(flashcards_db, "document_id", document_id, oldest_first=True)
+        )
+    else:
+        cards = iter_records(flashcards_db, oldest_first=True)
+    for count, card in enumerate(cards, 1):
+        writer.writerow([card.get("front", ""), card.get("back", "")])
+        if count % STREAM_BATCH_SIZE == 0:
+            yield buffer.take()
+    yield buffer.take()
+
+
+@app.get("/ai/flashcards/export")
+async def export_flashcards(
+    format: Literal["csv", "tsv", "anki"] = "csv",
+    document_id: Optional[List[str]] = Query(None),
+):
+    """Download flashcards as RFC 4180 CSV, TSV or an Anki import file
+
+    Repeat ``document_id`` to export the cards of several documents.
+    """
+    delimiter, media_type, extension, header = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        export_rows(document_id, delimiter, header),
+        media_type=f"{media_type}; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="flashcards.{extension}"'},
+    )
 
 
 @app.get("/ai/flashcards/export/anki")
-async def export_flashcards_anki(document_id: Optional[str] = None):
+async def export_flashcards_anki(document_id: Optional[List[str]] = Query(None)):
     """Export flashcards in Anki format"""
-    flashcards = flashcards_db
-    if document_id:
-        flashcards = [f for f in flashcards if f["document_id"] == document_id]
-    
-    # Generate Anki-format CSV
-    lines = ["Front,Back"]
-    for card in flashcards:
-        front = card["front"].replace(",", "，").replace("\n", " ")
-        back = card["back"].replace(",", "，").replace("\n", " ")
-        lines.append(f"{front},{back}")
-    
-    content = "\n".join(lines)
-    return JSONResponse(
-        content={"content": content, "format": "anki_csv"},
-        headers={"Content-Disposition": "attachment; filename=flashcards.csv"}
+    return await export_flashcards(format="anki", document_id=document_id)
+
+
+@inflight.coalesce(lambda doc, question_count, force_refresh=False: ("quizzes", materials_owner(doc), question_count, force_refresh))
+async def generate_quiz(doc: dict, question_count: int, force_refresh: bool = False) -> dict:
+    result, key, cached = await ai_generate(
+        "quizzes", doc, force_refresh, question_count=question_count
     )
+    existing = generated_records(quizzes_db, materials_owner(doc), key) if cached else []
+    if existing:
+        return existing[-1]
+    
+    quiz = {
+        "id": str(uuid.uuid4()),
+        "document_id": materials_owner(doc),
+        "questions": result.get("questions", []),
+        "created_at": datetime.now().isoformat(),
+        "generation_key": key,
+        "generation_id": str(uuid.uuid4()),
+    }
+    quizzes_db.append(quiz)
+    storage.save_quizzes()
+    return quiz
 
 
 @app.post("/ai/quizzes")
 async def create_quiz(request: QuizRequest):
     """Generate a quiz for a document"""
-    doc = next((d for d in documents_db if d["id"] == request.document_id), None)
-    if not doc:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    if doc["status"] != "completed":
-        raise HTTPException(status_code=400, detail="Document processing not completed")
-    
+    doc = completed_document(request.document_id)
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{AI_SERVICE_URL}/quizzes",
-                json={
-                    "document_id": request.document_id,
-                    "text_content": doc.get("text_content", ""),
-                    "question_count": request.question_count,
-                },
-                timeout=120.0
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            quiz = {
-                "id": str(uuid.uuid4()),
-                "document_id": request.document_id,
-                "questions": result.get("questions", []),
-                "created_at": datetime.now().isoformat(),
-            }
-            quizzes_db.append(quiz)
-            storage.save_quizzes()
-            return quiz
+        return await generate_quiz(doc, request.question_count, request.force_refresh)
     except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+        raise ai_service_error(e)
 
 
 @app.get("/ai/quizzes")
-async def get_quizzes(document_id: Optional[str] = None):
+async def get_quizzes(request: Request, document_id: Optional[str] = None, page: PageParams = Depends()):
     """Get quizzes, optionally filtered by document"""
-    quizzes = quizzes_db
     if document_id:
-        quizzes = [q for q in quizzes if q["document_id"] == document_id]
-    return quizzes
+        return list_response(request, quizzes_db, page, "document_id", materials_filter(document_id))
+    return list_response(request, quizzes_db, page)
+
+
+async def run_batch_item(request: BatchRequest, document_id: str, artifact: str) -> dict:
+    """Generate one artifact for one document, reporting failure instead of raising"""
+    item = {"document_id": document_id, "artifact": artifact}
+    try:
+        doc = completed_document(document_id)
+        if artifact == "summary":
+            result = await generate_summary(doc, request.summary_type, request.force_refresh)
+        elif artifact == "flashcards":
+            result = await generate_flashcards(doc, request.force_refresh)
+        else:
+            result = await generate_quiz(doc, request.question_count, request.force_refresh)
+        return {**item, "status": "ok", "result": result}
+    except HTTPException as e:
+        return {**item, "status": "error", "error": e.detail}
+    except httpx.HTTPError as e:
+        return {**item, "status": "error", "error": f"AI service error: {str(e)}"}
+    except Exception as e:
+        # e.g. a malformed AI service response; one bad item must not end the stream
+        print(f"Batch item {artifact} for {document_id} failed: {e}")
+        return {**item, "status": "error", "error": f"Generation error: {str(e)}"}
+
+
+@app.post("/ai/batch")
+async def create_batch(request: BatchRequest):
+    """Generate artifacts for many documents, streaming NDJSON results as they finish"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def bounded(document_id: str, artifact: str) -> dict:
+        async with semaphore:
+            return await run_batch_item(request, document_id, artifact)
+    
+    async def results():
+        tasks = [
+            asyncio.create_task(bounded(document_id, artifact))
+            for document_id in dict.fromkeys(request.document_ids)
+            for artifact in dict.fromkeys(request.artifacts)
+        ]
+        succeeded = failed = 0
+        try:
+            for finished in asyncio.as_completed(tasks):
+                item = await finished
+                if item["status"] == "ok":
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, "succeeded": succeeded, "failed": failed}) + "\n"
+        finally:
+            # The client went away: stop work that has not started yet. Calls
+            # shared with other requests keep running (see SingleFlight)
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+def chat_documents(request: ChatRequest) -> List[dict]:
+    """The documents a chat message should draw on"""
+    if request.document_ids:
+        return documents_db.get_many(request.document_ids)
+    return documents_db.find("status", "completed")
+
+
+def document_ref(doc: dict) -> dict:
+    """Reference to a document for the AI service: its id and content hash
+
+    The AI service keeps its own copy of the text keyed by hash, so the text
+    itself is only sent when the AI service reports it missing.
+    """
+    ref = {"id": doc["id"], "filename": doc["filename"]}
+    if doc.get("text_hash"):
+        ref["content_hash"] = doc["text_hash"]
+    else:
+        ref["text_content"] = storage.document_text(doc)
+    return ref
+
+
+def missing_documents(response: httpx.Response) -> List[str]:
+    """Document ids the AI service reported as unknown in a 409 response"""
+    if response.status_code != 409:
+        return []
+    try:
+        return response.json().get("detail", {}).get("missing", [])
+    except (ValueError, AttributeError):
+        return []
+
+
+async def upload_documents(docs: List[dict], document_ids: List[str]):
+    """Send the text of the given documents to the AI service's document store"""
+    for doc in docs:
+        if doc["id"] not in document_ids:
+            continue
+        response = await upstream.post(
+            AI_SERVICE, "/documents",
+            idempotent=True,
+            json={
+                "id": doc["id"],
+                "filename": doc["filename"],
+                "content_hash": doc["text_hash"],
+                "text_content": storage.document_text(doc),
+            },
+        )
+        response.raise_for_status()
+
+
+async def post_with_refs(path: str, docs: List[dict], payload: dict) -> httpx.Response:
+    """POST a payload that references docs, uploading their text once on a miss"""
+    response = await upstream.post(AI_SERVICE, path, json=payload)
+    missing = missing_documents(response)
+    if missing:
+        await upload_documents(docs, missing)
+        response = await upstream.post(AI_SERVICE, path, json=payload)
+    response.raise_for_status()
+    return response
+
+
+async def stream_with_refs(path: str, docs: List[dict], payload: dict):
+    """Like post_with_refs, for the AI service's NDJSON streaming endpoints"""
+    try:
+        async for message in upstream.stream_ndjson(AI_SERVICE, path, json=payload):
+            yield message
+        return
+    except httpx.HTTPStatusError as e:
+        missing = missing_documents(e.response)
+        if not missing:
+            raise
+    # The miss is reported before any record is streamed, so retrying is safe
+    await upload_documents(docs, missing)
+    async for message in upstream.stream_ndjson(AI_SERVICE, path, json=payload):
+        yield message
+
+
+def chat_payload(request: ChatRequest, docs: List[dict]) -> dict:
+    return {
+        "message": request.message,
+        "documents": [document_ref(d) for d in docs],
+    }
+
+
+def record_chat(message: str, content: str, citations: List[str]) -> dict:
+    """Save a user message and the assistant's reply to the chat history"""
+    chat_message = {
+        "id": str(uuid.uuid4()),
+        "role": "assistant",
+        "content": content,
+        "citations": citations,
+        "timestamp": datetime.now().isoformat(),
+    }
+    chat_history_db.append({
+        "id": str(uuid.uuid4()),
+        "role": "user",
+        "content": message,
+        "timestamp": datetime.now().isoformat(),
+    })
+    chat_history_db.append(chat_message)
+    storage.save_chat_history()
+    return chat_message
 
 
 @app.post("/ai/chat")
 async def chat(request: ChatRequest):
     """Send a chat message and get AI response with RAG"""
     try:
-        # Get relevant documents
-        relevant_docs = []
-        if request.document_ids:
-            relevant_docs = [d for d in documents_db if d["id"] in request.document_ids]
-        else:
-            relevant_docs = [d for d in documents_db if d["status"] == "completed"]
+        docs = chat_documents(request)
+        response = await post_with_refs("/chat", docs, chat_payload(request, docs))
+        result = response.json()
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{AI_SERVICE_URL}/chat",
-                json={
-                    "message": request.message,
-                    "documents": [
-                        {
-                            "id": d["id"],
-                            "text_content": d.get("text_content", ""),
-                            "filename": d["filename"],
-                        }
-                        for d in relevant_docs
-                    ],
-                },
-                timeout=120.0
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            chat_message = {
-                "id": str(uuid.uuid4()),
-                "role": "assistant",
-                "content": result.get("content", ""),
-                "citations": result.get("citations", []),
-                "timestamp": datetime.now().isoformat(),
-            }
-            chat_history_db.append({
-                "id": str(uuid.uuid4()),
-                "role": "user",
-                "content": request.message,
-                "timestamp": datetime.now().isoformat(),
-            })
-            chat_history_db.append(chat_message)
-            storage.save_chat_history()
-            
-            return chat_message
+        return record_chat(request.message, result.get("content", ""), result.get("citations", []))
     except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+        raise ai_service_error(e)
+
+
+@app.post("/ai/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Send a chat message and stream the AI response as Server-Sent Events
+
+    Emits ``token`` events with text deltas, then a ``done`` event with the
+    saved assistant message (or an ``error`` event).
+    """
+    docs = chat_documents(request)
+    payload = chat_payload(request, docs)
+    
+    async def events():
+        parts = []
+        citations = []
+        try:
+            async for message in stream_with_refs("/chat/stream", docs, payload):
+                if "delta" in message:
+                    parts.append(message["delta"])
+                    yield sse_event("token", {"delta": message["delta"]})
+                elif "error" in message:
+                    yield sse_event("error", {"detail": message["error"]})
+                    return
+                elif message.get("done"):
+                    citations = message.get("citations", [])
+        except httpx.HTTPError as e:
+            yield sse_event("error", {"detail": f"AI service error: {str(e)}"})
+            return
+        
+        yield sse_event("done", record_chat(request.message, "".join(parts), citations))
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 
 @app.get("/ai/chat/history")
-async def get_chat_history():
+async def get_chat_history(request: Request, page: PageParams = Depends()):
     """Get chat history"""
-    return chat_history_db
+    return list_response(request, chat_history_db, page)
+
+
+@inflight.coalesce(lambda docs: ("study-plans", tuple(sorted(d["id"] for d in docs))))
+async def generate_study_plan(docs: List[dict]) -> dict:
+    response = await post_with_refs("/study-plans", docs, {"documents": [document_ref(d) for d in docs]})
+    result = response.json()
+    
+    study_plan = {
+        "id": str(uuid.uuid4()),
+        "topics": result.get("topics", []),
+        "created_at": datetime.now().isoformat(),
+    }
+    study_plans_db.append(study_plan)
+    storage.save_study_plans()
+    return study_plan
 
 
 @app.post("/ai/study-plans")
 async def create_study_plan(request: StudyPlanRequest):
     """Generate a personalized study plan"""
-    docs = [d for d in documents_db if d["id"] in request.document_ids]
-    if len(docs) != len(request.document_ids):
+    docs = documents_db.get_many(request.document_ids)
+    if len(docs) != len(set(request.document_ids)):
         raise HTTPException(status_code=404, detail="Some documents not found")
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{AI_SERVICE_URL}/study-plans",
-                json={
-                    "documents": [
-                        {
-                            "id": d["id"],
-                            "filename": d["filename"],
-                            "text_content": d.get("text_content", ""),
-                        }
-                        for d in docs
-                    ],
-                },
-                timeout=120.0
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            study_plan = {
-                "id": str(uuid.uuid4()),
-                "topics": result.get("topics", []),
-                "created_at": datetime.now().isoformat(),
-            }
-            study_plans_db.append(study_plan)
-            storage.save_study_plans()
-            return study_plan
+        return await generate_study_plan(docs)
     except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+        raise ai_service_error(e)
 
 
 @app.get("/ai/study-plans")
-async def get_study_plans():
-    """Get all study plans"""
-    return study_plans_db
+async def get_study_plans(request: Request, page: PageParams = Depends()):
+    """Get study plans"""
+    return list_response(request, study_plans_db, page)
 
 
 if __name__ == "__main__":
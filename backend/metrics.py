@@ -0,0 +1,79 @@
+"""Prometheus metrics and request ids for the backend"""
+import os
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Passed to the document and AI services so one request can be followed across all three
+REQUEST_ID_HEADER = "X-Request-ID"
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Requests slower than this are logged with their request id
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "2"))
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request, by route template",
+    ["method", "route", "status"],
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Time of calls to the document and AI services",
+    ["service", "path", "outcome"],
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total",
+    "Retried calls to the document and AI services",
+    ["service"],
+)
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    "upstream_circuit_open",
+    "1 while the circuit breaker for a service is open",
+    ["service"],
+)
+STORAGE_FLUSH = Histogram(
+    "storage_flush_duration_seconds",
+    "Time to persist one collection",
+    ["collection"],
+)
+INGEST_QUEUE_DEPTH = Gauge(
+    "ingest_queue_depth",
+    "Documents waiting in the ingestion queue",
+)
+INGEST_STAGE = Histogram(
+    "ingest_stage_duration_seconds",
+    "Time spent in each ingestion stage",
+    ["stage"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+GENERATION_CACHE = Counter(
+    "generation_cache_requests_total",
+    "Generation cache lookups",
+    ["endpoint", "result"],
+)
+
+
+def new_request_id(incoming: Optional[str] = None) -> str:
+    """Use the caller's request id if it sent one, otherwise start a new one"""
+    value = incoming or uuid.uuid4().hex
+    request_id.set(value)
+    return value
+
+
+def route_template(request) -> str:
+    """The matched route path (e.g. /documents/{document_id}), keeping label cardinality low"""
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+def log_if_slow(rid: str, method: str, route: str, status: int, elapsed: float):
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        print(f"Slow request {rid}: {method} {route} -> {status} in {elapsed:.3f}s")
+
+
+def render():
+    """Current metrics in the Prometheus text format, with its content type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
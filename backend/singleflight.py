@@ -0,0 +1,51 @@
+"""Coalescing of concurrent identical requests into one upstream call"""
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers share its result
+
+    The first caller for a key starts the work in a task owned by the
+    SingleFlight. Every caller, including that first one, awaits the task
+    through a shield, so any caller can give up (a client disconnecting, a
+    batch being cancelled) without cancelling the call the others share.
+    The call runs to completion even if everyone gives up, and its result
+    still reaches the generation cache. Once it finishes, the key is
+    released, so later calls run again (and can then be answered by the
+    generation cache).
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def _release(self, key: Hashable, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case nobody was left waiting
+            task.exception()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._release, key))
+        return await asyncio.shield(task)
+
+    def coalesce(self, key_fn: Callable[..., Hashable]):
+        """Decorator: coalesce calls of an async function by key_fn(*args, **kwargs)"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                return await self.do(key_fn(*args, **kwargs), lambda: fn(*args, **kwargs))
+            return wrapper
+        return decorator
+
+
+inflight = SingleFlight()
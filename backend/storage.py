@@ -1,9 +1,19 @@
 """File-based persistence for StudyBudds backend"""
+import base64
+import binascii
+import bisect
+import hashlib
 import json
 import os
-from typing import List, Dict, Any
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import List, Dict, Any, Optional, Iterable, Iterator
 from pathlib import Path
 
+from metrics import STORAGE_FLUSH
+
 STORAGE_DIR = Path("./data")
 STORAGE_DIR.mkdir(exist_ok=True)
 
@@ -15,15 +25,52 @@ QUIZZES_FILE = STORAGE_DIR / "quizzes.json"
 CHAT_HISTORY_FILE = STORAGE_DIR / "chat_history.json"
 STUDY_PLANS_FILE = STORAGE_DIR / "study_plans.json"
 
+# Fields each collection keeps a secondary index on (besides id)
+INDEX_FIELDS = {
+    "documents": ("status", "text_hash", "file_hash"),
+    "summaries": ("document_id",),
+    "flashcards": ("document_id",),
+    "quizzes": ("document_id",),
+    "chat_history": (),
+    "study_plans": (),
+}
+
+COLLECTION_FILES = {
+    "documents": DOCUMENTS_FILE,
+    "summaries": SUMMARIES_FILE,
+    "flashcards": FLASHCARDS_FILE,
+    "quizzes": QUIZZES_FILE,
+    "chat_history": CHAT_HISTORY_FILE,
+    "study_plans": STUDY_PLANS_FILE,
+}
+
+# Extracted document text, one content-addressed file per distinct text
+BLOBS_DIR = STORAGE_DIR / "blobs"
+
+# Storage mode: "json" rewrites a collection file on every save,
+# "journal" appends change records and compacts them in the background,
+# "sqlite" keeps collections in indexed SQLite tables
+STORAGE_MODE = os.getenv("STORAGE_MODE", "json")
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", str(STORAGE_DIR / "studybudds.db")))
+JOURNAL_DIR = STORAGE_DIR / "journal"
+JOURNAL_SEGMENT_BYTES = int(os.getenv("JOURNAL_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+JOURNAL_COMPACT_SEGMENTS = int(os.getenv("JOURNAL_COMPACT_SEGMENTS", "4"))
+
+# Write-behind: saves only mark collections dirty and a background thread
+# flushes them after STORAGE_FLUSH_INTERVAL seconds or STORAGE_FLUSH_MAX_PENDING saves
+STORAGE_WRITE_BEHIND = os.getenv("STORAGE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "1.0"))
+STORAGE_FLUSH_MAX_PENDING = int(os.getenv("STORAGE_FLUSH_MAX_PENDING", "100"))
+
 
 def load_data(file_path: Path, default: List = None) -> List[Dict[str, Any]]:
     """Load data from JSON file"""
     if default is None:
         default = []
-    
+
     if not file_path.exists():
         return default.copy()
-    
+
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
@@ -33,52 +80,871 @@ def load_data(file_path: Path, default: List = None) -> List[Dict[str, Any]]:
         return default.copy()
 
 
+def atomic_write(file_path: Path, payload: bytes):
+    """Write a file via a fsync'd temp file and an atomic rename
+
+    The temp file is unique to each call, so concurrent writers of the
+    same path (e.g. two uploads of one text) cannot rename each other's.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=file_path.parent, prefix=file_path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
 def save_data(file_path: Path, data: List[Dict[str, Any]]) -> bool:
     """Save data to JSON file"""
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        payload = json.dumps(data, indent=2, ensure_ascii=False)
+        atomic_write(file_path, payload.encode('utf-8'))
         return True
-    except IOError as e:
+    except (IOError, OSError) as e:
         print(f"Error saving {file_path}: {e}")
         return False
 
 
+class Collection:
+    """Ordered, id-keyed records that remember their unsaved changes
+
+    Besides the id map, a collection keeps a secondary index for each of
+    its ``index_fields`` (value -> records), maintained on append, update
+    and delete. Records must be changed through ``update`` so the indexes
+    stay in sync. Mutations hold ``lock`` so a background flush can take a
+    consistent view.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        records: Iterable[Dict[str, Any]] = (),
+        index_fields: Iterable[str] = (),
+    ):
+        self.name = name
+        self.lock = threading.RLock()
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._changes: List[Dict[str, Any]] = []
+        self._indexes: Dict[str, Dict[Any, Dict[str, Dict[str, Any]]]] = {
+            field: {} for field in index_fields
+        }
+        # Insertion sequence numbers for cursor pagination. _order/_order_ids
+        # are append-only; deleted entries stay as tombstones until compacted.
+        self._seq: Dict[str, int] = {}
+        self._order: List[int] = []
+        self._order_ids: List[str] = []
+        self._next_seq = 1
+        for record in records:
+            self._put(record)
+        # Bumped on every change, for conditional GETs (see Storage.epoch)
+        self.version = 0
+
+    def _index(self, record: Dict[str, Any]):
+        for field, index in self._indexes.items():
+            value = record.get(field)
+            if value is not None:
+                index.setdefault(value, {})[record["id"]] = record
+
+    def _unindex(self, record: Dict[str, Any]):
+        for field, index in self._indexes.items():
+            bucket = index.get(record.get(field))
+            if bucket is not None:
+                bucket.pop(record["id"], None)
+                if not bucket:
+                    del index[record.get(field)]
+
+    def _put(self, record: Dict[str, Any]):
+        previous = self._records.get(record["id"])
+        if previous is not None:
+            self._unindex(previous)
+        else:
+            self._seq[record["id"]] = self._next_seq
+            self._order.append(self._next_seq)
+            self._order_ids.append(record["id"])
+            self._next_seq += 1
+        self._records[record["id"]] = record
+        self._index(record)
+
+    def _forget(self, record_id: str):
+        self._seq.pop(record_id, None)
+        if len(self._order) > 2 * len(self._seq) + 64:
+            live = [(seq, rid) for seq, rid in zip(self._order, self._order_ids) if self._seq.get(rid) == seq]
+            self._order = [seq for seq, _ in live]
+            self._order_ids = [rid for _, rid in live]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(list(self._records.values()))
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, record_id: str) -> bool:
+        return record_id in self._records
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Return every record in insertion order"""
+        return list(self._records.values())
+
+    def get(self, record_id: str) -> Optional[Dict[str, Any]]:
+        """Look up a record by id"""
+        return self._records.get(record_id)
+
+    def get_many(self, record_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        """Look up several records by id, skipping unknown and repeated ids"""
+        return [
+            self._records[record_id]
+            for record_id in dict.fromkeys(record_ids)
+            if record_id in self._records
+        ]
+
+    def find(self, field: str, value: Any) -> List[Dict[str, Any]]:
+        """Return the records whose field equals value, in insertion order"""
+        index = self._indexes.get(field)
+        if index is None:
+            return [r for r in self._records.values() if r.get(field) == value]
+        # Updates re-add a record at the end of its bucket, so order by sequence
+        return sorted(index.get(value, {}).values(), key=lambda r: self._seq[r["id"]])
+
+    def by_document(self, document_id: str) -> List[Dict[str, Any]]:
+        """Return the records that belong to a document"""
+        return self.find("document_id", document_id)
+
+    def page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        field: Optional[str] = None,
+        value: Any = None,
+        oldest_first: bool = False,
+    ) -> tuple[List[Dict[str, Any]], Optional[str]]:
+        """Return up to limit records, newest first (or oldest first), and the
+        cursor for the next page"""
+        after = decode_cursor(cursor) if cursor else None
+        with self.lock:
+            if field is not None:
+                # Filtered pages walk the (indexed) matches rather than the whole collection
+                matches = [(self._seq[r["id"]], r) for r in self.find(field, value)]
+                if not oldest_first:
+                    matches.reverse()
+                if after is not None:
+                    matches = [
+                        (seq, r) for seq, r in matches
+                        if (seq > after if oldest_first else seq < after)
+                    ]
+                items = matches[:limit + 1]
+            elif oldest_first:
+                items = []
+                i = bisect.bisect_right(self._order, after) if after is not None else 0
+                while i < len(self._order) and len(items) <= limit:
+                    seq, record_id = self._order[i], self._order_ids[i]
+                    if self._seq.get(record_id) == seq:
+                        items.append((seq, self._records[record_id]))
+                    i += 1
+            else:
+                items = []
+                i = bisect.bisect_left(self._order, after) if after is not None else len(self._order)
+                while i > 0 and len(items) <= limit:
+                    i -= 1
+                    seq, record_id = self._order[i], self._order_ids[i]
+                    if self._seq.get(record_id) == seq:
+                        items.append((seq, self._records[record_id]))
+        next_cursor = encode_cursor(items[limit - 1][0]) if len(items) > limit else None
+        return [r for _, r in items[:limit]], next_cursor
+
+    def append(self, record: Dict[str, Any]):
+        """Add (or replace) a record"""
+        with self.lock:
+            self._put(record)
+            self.version += 1
+            self._changes.append({"op": "put", "record": record})
+
+    def update(self, record_id: str, **fields) -> Optional[Dict[str, Any]]:
+        """Update fields of an existing record"""
+        with self.lock:
+            record = self._records.get(record_id)
+            if record is None:
+                return None
+            self._unindex(record)
+            record.update(fields)
+            self._index(record)
+            self.version += 1
+            self._changes.append({"op": "put", "record": record})
+            return record
+
+    def delete(self, record_id: str) -> bool:
+        """Remove a record by id"""
+        with self.lock:
+            record = self._records.pop(record_id, None)
+            if record is None:
+                return False
+            self._unindex(record)
+            self._forget(record_id)
+            self.version += 1
+            self._changes.append({"op": "delete", "id": record_id})
+            return True
+
+    def drain_changes(self) -> List[Dict[str, Any]]:
+        """Hand over the changes made since the last save"""
+        with self.lock:
+            changes, self._changes = self._changes, []
+            return changes
+
+    def requeue_changes(self, changes: List[Dict[str, Any]]):
+        """Put back changes that could not be saved, ahead of newer ones"""
+        with self.lock:
+            self._changes[:0] = changes
+
+
+def encode_cursor(seq: int) -> str:
+    """Opaque pagination cursor pointing just past a record"""
+    return base64.urlsafe_b64encode(str(seq).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """Inverse of encode_cursor, raises ValueError for malformed cursors"""
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (UnicodeDecodeError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def apply_change(records: Dict[str, Dict[str, Any]], change: Dict[str, Any]):
+    """Apply one journal change record to an id-keyed dict"""
+    if change.get("op") == "put":
+        record = change["record"]
+        records[record["id"]] = record
+    elif change.get("op") == "delete":
+        records.pop(change["id"], None)
+
+
+class JsonFileBackend:
+    """Rewrites a collection's whole JSON file on every save"""
+
+    def open(self, name: str) -> Collection:
+        return Collection(name, load_data(COLLECTION_FILES[name], []), INDEX_FIELDS[name])
+
+    def persist(self, collection: Collection) -> bool:
+        with collection.lock:
+            collection.drain_changes()
+            records = collection.all()
+            try:
+                payload = json.dumps(records, indent=2, ensure_ascii=False)
+            except (TypeError, ValueError) as e:
+                print(f"Error saving {collection.name}: {e}")
+                return False
+        try:
+            atomic_write(COLLECTION_FILES[collection.name], payload.encode('utf-8'))
+            return True
+        except (IOError, OSError) as e:
+            print(f"Error saving {COLLECTION_FILES[collection.name]}: {e}")
+            return False
+
+    def close(self):
+        pass
+
+
+class CollectionJournal:
+    """Append-only change log for one collection
+
+    Layout under ``data/journal/<name>/``:
+      snapshot.json      {"segment": N, "records": [...]} covering segments <= N
+      segment-XXXXXXXX.log  one JSON change record per line
+
+    Each save appends its change records to the active segment in a single
+    write followed by fsync. Once the active segment grows past
+    JOURNAL_SEGMENT_BYTES a new one is started; closed segments are folded
+    into the snapshot by the compactor and then removed.
+    """
+
+    def __init__(self, name: str, directory: Path):
+        self.name = name
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.snapshot_file = directory / "snapshot.json"
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        # Always start a fresh segment so a torn tail from a crash stays at the
+        # end of a closed segment instead of being followed by new records
+        segments = self._segments()
+        self._active = max(segments[-1] if segments else 0, self._snapshot_segment()) + 1
+        self._handle = None
+
+    def _segment_path(self, seq: int) -> Path:
+        return self.directory / f"segment-{seq:08d}.log"
+
+    def _segments(self) -> List[int]:
+        return sorted(
+            int(p.stem.split("-", 1)[1]) for p in self.directory.glob("segment-*.log")
+        )
+
+    def _read_snapshot(self) -> Dict[str, Any]:
+        if not self.snapshot_file.exists():
+            return {"segment": 0, "records": []}
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error loading {self.snapshot_file}: {e}")
+            return {"segment": 0, "records": []}
+
+    def _snapshot_segment(self) -> int:
+        return self._read_snapshot().get("segment", 0)
+
+    def _replay_segment(self, seq: int, records: Dict[str, Dict[str, Any]]):
+        with open(self._segment_path(seq), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final write from a crash; everything before it is intact
+                    print(f"Skipping truncated record in {self.name} segment {seq}")
+                    break
+                apply_change(records, change)
+
+    def seed(self, records: List[Dict[str, Any]]):
+        """Create the first snapshot from existing data"""
+        payload = json.dumps({"segment": 0, "records": records}, ensure_ascii=False)
+        atomic_write(self.snapshot_file, payload.encode('utf-8'))
+
+    def has_data(self) -> bool:
+        return self.snapshot_file.exists() or bool(self._segments())
+
+    def replay(self) -> List[Dict[str, Any]]:
+        """Rebuild the collection from the snapshot and newer segments"""
+        snapshot = self._read_snapshot()
+        records = {r["id"]: r for r in snapshot.get("records", [])}
+        for seq in self._segments():
+            if seq > snapshot.get("segment", 0):
+                self._replay_segment(seq, records)
+        return list(records.values())
+
+    def append(self, payload: bytes) -> bool:
+        """Durably append encoded change records, returns True if a segment was closed"""
+        if not payload:
+            return False
+        with self._lock:
+            if self._handle is None:
+                self._handle = open(self._segment_path(self._active), 'ab')
+            self._handle.write(payload)
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            if self._handle.tell() < JOURNAL_SEGMENT_BYTES:
+                return False
+            self._handle.close()
+            self._handle = None
+            self._active += 1
+            return True
+
+    def closed_segments(self) -> List[int]:
+        with self._lock:
+            active = self._active
+        return [seq for seq in self._segments() if seq < active]
+
+    def compact(self):
+        """Fold closed segments into a new snapshot"""
+        with self._compact_lock:
+            closed = self.closed_segments()
+            if not closed:
+                return
+            snapshot = self._read_snapshot()
+            records = {r["id"]: r for r in snapshot.get("records", [])}
+            for seq in closed:
+                if seq > snapshot.get("segment", 0):
+                    self._replay_segment(seq, records)
+            payload = json.dumps(
+                {"segment": closed[-1], "records": list(records.values())},
+                ensure_ascii=False,
+            )
+            atomic_write(self.snapshot_file, payload.encode('utf-8'))
+            # The snapshot now covers these segments, so a crash from here on is harmless
+            for seq in closed:
+                self._segment_path(seq).unlink(missing_ok=True)
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+
+class JournalBackend:
+    """Appends change records per collection and compacts them in the background"""
+
+    def __init__(self, directory: Path = JOURNAL_DIR):
+        self.directory = directory
+        self.journals: Dict[str, CollectionJournal] = {}
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._compactor = threading.Thread(
+            target=self._compact_loop, name="journal-compactor", daemon=True
+        )
+        self._compactor.start()
+
+    def _journal(self, name: str) -> CollectionJournal:
+        if name not in self.journals:
+            self.journals[name] = CollectionJournal(name, self.directory / name)
+        return self.journals[name]
+
+    def open(self, name: str) -> Collection:
+        journal = self._journal(name)
+        if not journal.has_data():
+            # First start in journal mode: take over the existing JSON file
+            journal.seed(load_data(COLLECTION_FILES[name], []))
+        records = journal.replay()
+        if len(journal.closed_segments()) >= JOURNAL_COMPACT_SEGMENTS:
+            self._wakeup.set()
+        return Collection(name, records, INDEX_FIELDS[name])
+
+    def persist(self, collection: Collection) -> bool:
+        with collection.lock:
+            changes = collection.drain_changes()
+            payload = "".join(
+                json.dumps(change, ensure_ascii=False) + "\n" for change in changes
+            ).encode('utf-8')
+        try:
+            journal = self._journal(collection.name)
+            if journal.append(payload):
+                if len(journal.closed_segments()) >= JOURNAL_COMPACT_SEGMENTS:
+                    self._wakeup.set()
+            return True
+        except (IOError, OSError) as e:
+            print(f"Error appending to {collection.name} journal: {e}")
+            collection.requeue_changes(changes)
+            return False
+
+    def _compact_loop(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            for journal in list(self.journals.values()):
+                try:
+                    journal.compact()
+                except (IOError, OSError, json.JSONDecodeError) as e:
+                    print(f"Error compacting {journal.name} journal: {e}")
+
+    def close(self):
+        self._stopping = True
+        self._wakeup.set()
+        self._compactor.join(timeout=5)
+        for journal in self.journals.values():
+            journal.close()
+
+
+def sqlite_field(field: str) -> str:
+    """SQL expression for a record field; document_id has its own column"""
+    if field == "document_id":
+        return "document_id"
+    return f"json_extract(data, '$.{field}')"
+
+
+class SqliteCollection:
+    """Collection stored in a SQLite table, indexed on id and document_id
+
+    Writes go into the backend's open transaction and become durable when
+    the collection is saved. Records come back as fresh dicts, so changes
+    must go through ``update`` rather than mutating a returned record.
+    """
+
+    def __init__(self, name: str, backend: "SqliteBackend"):
+        self.name = name
+        self.backend = backend
+        self.lock = backend.lock
+        # Counted in this process only; this backend has a single writer
+        self.version = 0
+
+    def _query(self, sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        with self.backend.lock:
+            rows = self.backend.conn.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self.all())
+
+    def __len__(self) -> int:
+        with self.backend.lock:
+            return self.backend.conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+
+    def __contains__(self, record_id: str) -> bool:
+        return self.get(record_id) is not None
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Return every record in insertion order"""
+        return self._query(f"SELECT data FROM {self.name} ORDER BY seq")
+
+    def get(self, record_id: str) -> Optional[Dict[str, Any]]:
+        """Look up a record by id"""
+        rows = self._query(f"SELECT data FROM {self.name} WHERE id = ?", (record_id,))
+        return rows[0] if rows else None
+
+    def get_many(self, record_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        """Look up several records by id, skipping unknown and repeated ids"""
+        record_ids = list(dict.fromkeys(record_ids))
+        if not record_ids:
+            return []
+        placeholders = ", ".join("?" for _ in record_ids)
+        found = {
+            r["id"]: r
+            for r in self._query(
+                f"SELECT data FROM {self.name} WHERE id IN ({placeholders})", tuple(record_ids)
+            )
+        }
+        return [found[record_id] for record_id in record_ids if record_id in found]
+
+    def find(self, field: str, value: Any) -> List[Dict[str, Any]]:
+        """Return the records whose field equals value"""
+        return self._query(
+            f"SELECT data FROM {self.name} WHERE {sqlite_field(field)} = ? ORDER BY seq",
+            (value,),
+        )
+
+    def by_document(self, document_id: str) -> List[Dict[str, Any]]:
+        """Return the records that belong to a document"""
+        return self.find("document_id", document_id)
+
+    def page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        field: Optional[str] = None,
+        value: Any = None,
+        oldest_first: bool = False,
+    ) -> tuple[List[Dict[str, Any]], Optional[str]]:
+        """Return up to limit records, newest first (or oldest first), and the
+        cursor for the next page"""
+        conditions, params = [], []
+        if cursor:
+            conditions.append("seq > ?" if oldest_first else "seq < ?")
+            params.append(decode_cursor(cursor))
+        if field is not None:
+            conditions.append(f"{sqlite_field(field)} = ?")
+            params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.backend.lock:
+            rows = self.backend.conn.execute(
+                f"SELECT seq, data FROM {self.name} {where} "
+                f"ORDER BY seq {'ASC' if oldest_first else 'DESC'} LIMIT ?",
+                (*params, limit + 1),
+            ).fetchall()
+        next_cursor = encode_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+        return [json.loads(row[1]) for row in rows[:limit]], next_cursor
+
+    def append(self, record: Dict[str, Any]):
+        """Add (or replace) a record"""
+        with self.backend.lock:
+            self.backend.conn.execute(
+                f"INSERT INTO {self.name} (id, document_id, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET document_id = excluded.document_id, data = excluded.data",
+                (record["id"], record.get("document_id"), json.dumps(record, ensure_ascii=False)),
+            )
+            self.version += 1
+
+    def update(self, record_id: str, **fields) -> Optional[Dict[str, Any]]:
+        """Update fields of an existing record"""
+        record = self.get(record_id)
+        if record is None:
+            return None
+        record.update(fields)
+        self.append(record)
+        return record
+
+    def delete(self, record_id: str) -> bool:
+        """Remove a record by id"""
+        with self.backend.lock:
+            cursor = self.backend.conn.execute(f"DELETE FROM {self.name} WHERE id = ?", (record_id,))
+            if cursor.rowcount > 0:
+                self.version += 1
+        return cursor.rowcount > 0
+
+
+class SqliteBackend:
+    """Keeps every collection in one SQLite database in WAL mode"""
+
+    def __init__(self, path: Path = SQLITE_PATH):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY)")
+        self.conn.commit()
+
+    def open(self, name: str) -> SqliteCollection:
+        with self.lock:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "id TEXT NOT NULL UNIQUE, "
+                "document_id TEXT, "
+                "data TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{name}_document_id ON {name} (document_id)"
+            )
+            for field in INDEX_FIELDS[name]:
+                if field != "document_id":
+                    self.conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS idx_{name}_{field} ON {name} ({sqlite_field(field)})"
+                    )
+            self.conn.commit()
+        collection = SqliteCollection(name, self)
+        self._migrate(collection)
+        return collection
+
+    def _migrate(self, collection: SqliteCollection):
+        """Import the collection's JSON file the first time it is opened"""
+        with self.lock:
+            done = self.conn.execute(
+                "SELECT 1 FROM migrations WHERE name = ?", (collection.name,)
+            ).fetchone()
+            if done:
+                return
+            records = load_data(COLLECTION_FILES[collection.name], [])
+            for record in records:
+                collection.append(record)
+            self.conn.execute("INSERT INTO migrations (name) VALUES (?)", (collection.name,))
+            self.conn.commit()
+        if records:
+            print(f"Migrated {len(records)} {collection.name} records into SQLite")
+
+    def persist(self, collection: SqliteCollection) -> bool:
+        try:
+            with self.lock:
+                self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Error saving {collection.name} to SQLite: {e}")
+            return False
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class BlobStore:
+    """Content-addressed store for document text
+
+    Each distinct text is written once to ``blobs/<hh>/<sha256>.txt`` and
+    read back on demand, so document records only carry the hash.
+    """
+
+    def __init__(self, directory: Path = BLOBS_DIR):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, blob_hash: str) -> Path:
+        return self.directory / blob_hash[:2] / f"{blob_hash}.txt"
+
+    def put(self, text: str) -> tuple[str, int]:
+        """Store text and return its (sha256, size in bytes)"""
+        payload = text.encode('utf-8')
+        blob_hash = hashlib.sha256(payload).hexdigest()
+        path = self.path(blob_hash)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            atomic_write(path, payload)
+        return blob_hash, len(payload)
+
+    def exists(self, blob_hash: str) -> bool:
+        return self.path(blob_hash).exists()
+
+    def read(self, blob_hash: str) -> str:
+        """Read a whole blob as text"""
+        try:
+            return self.path(blob_hash).read_text(encoding='utf-8')
+        except IOError as e:
+            print(f"Error reading blob {blob_hash}: {e}")
+            return ""
+
+    def read_range(self, blob_hash: str, start: int, end: int) -> bytes:
+        """Read bytes start..end (inclusive) of a blob"""
+        with open(self.path(blob_hash), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start + 1)
+
+    def size(self, blob_hash: str) -> int:
+        return self.path(blob_hash).stat().st_size
+
+    def delete(self, blob_hash: str):
+        self.path(blob_hash).unlink(missing_ok=True)
+
+
+class WriteBehindFlusher:
+    """Coalesces saves and persists dirty collections from a background thread
+
+    ``mark`` only records that a collection needs saving. The flusher waits
+    up to ``interval`` seconds after the first mark (or until ``max_pending``
+    saves pile up) and then persists each dirty collection once, so a burst
+    of writes costs a single flush per collection.
+    """
+
+    def __init__(self, backend, interval: float, max_pending: int):
+        self.backend = backend
+        self.interval = interval
+        self.max_pending = max_pending
+        self._dirty: Dict[str, Any] = {}
+        self._pending = 0
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="storage-flusher", daemon=True)
+        self._thread.start()
+
+    def mark(self, collection) -> bool:
+        with self._cond:
+            self._dirty[collection.name] = collection
+            self._pending += 1
+            if self._pending == 1 or self._pending >= self.max_pending:
+                self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._stopping:
+                    self._cond.wait()
+                if not self._dirty:
+                    return
+                deadline = time.monotonic() + self.interval
+                while self._pending < self.max_pending and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                dirty = list(self._dirty.values())
+                self._dirty, self._pending = {}, 0
+            self._flush(dirty)
+
+    def _flush(self, collections: List[Any]):
+        for collection in collections:
+            if not persist_timed(self.backend, collection) and not self._stopping:
+                # Try again on the next round
+                self.mark(collection)
+
+    def stop(self):
+        """Flush everything still dirty and stop the thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+
+
+def persist_timed(backend, collection) -> bool:
+    """Persist a collection, recording how long it took"""
+    with STORAGE_FLUSH.labels(collection.name).time():
+        return backend.persist(collection)
+
+
+def create_backend(mode: str):
+    """Build the persistence backend for a storage mode"""
+    if mode == "journal":
+        return JournalBackend()
+    if mode == "sqlite":
+        return SqliteBackend()
+    if mode != "json":
+        print(f"Unknown STORAGE_MODE '{mode}', falling back to json")
+    return JsonFileBackend()
+
+
 class Storage:
     """Storage manager for all data types"""
-    
-    def __init__(self):
-        self.documents = load_data(DOCUMENTS_FILE, [])
-        self.summaries = load_data(SUMMARIES_FILE, [])
-        self.flashcards = load_data(FLASHCARDS_FILE, [])
-        self.quizzes = load_data(QUIZZES_FILE, [])
-        self.chat_history = load_data(CHAT_HISTORY_FILE, [])
-        self.study_plans = load_data(STUDY_PLANS_FILE, [])
-    
+
+    def __init__(self, mode: Optional[str] = None, write_behind: Optional[bool] = None):
+        self.mode = mode or STORAGE_MODE
+        self.backend = create_backend(self.mode)
+        self.blobs = BlobStore()
+        self.flusher = None
+        if STORAGE_WRITE_BEHIND if write_behind is None else write_behind:
+            self.flusher = WriteBehindFlusher(
+                self.backend, STORAGE_FLUSH_INTERVAL, STORAGE_FLUSH_MAX_PENDING
+            )
+        self._closed = False
+        # Collection versions restart at 0 with the process; the epoch keeps
+        # ETags from before a restart from matching
+        self.epoch = os.urandom(4).hex()
+        self.documents = self._open("documents")
+        self.summaries = self._open("summaries")
+        self.flashcards = self._open("flashcards")
+        self.quizzes = self._open("quizzes")
+        self.chat_history = self._open("chat_history")
+        self.study_plans = self._open("study_plans")
+        self._move_text_to_blobs()
+
+    def _open(self, name: str) -> Collection:
+        return self.backend.open(name)
+
+    def etag(self, *collections) -> str:
+        """Weak ETag that changes whenever any of the collections changes"""
+        versions = "-".join(f"{c.name}.{c.version}" for c in collections)
+        return f'W/"{self.epoch}-{versions}"'
+
+    def _save(self, collection) -> bool:
+        if self.flusher is not None:
+            return self.flusher.mark(collection)
+        return persist_timed(self.backend, collection)
+
+    def _move_text_to_blobs(self):
+        """Move text still embedded in document records into the blob store"""
+        moved = 0
+        for doc in self.documents:
+            if "text_content" not in doc:
+                continue
+            record = {k: v for k, v in doc.items() if k != "text_content"}
+            if doc["text_content"] is not None:
+                record["text_hash"], record["text_size"] = self.blobs.put(doc["text_content"])
+            self.documents.append(record)
+            moved += 1
+        if moved:
+            self.save_documents()
+            print(f"Moved text of {moved} documents into the blob store")
+
+    def document_text(self, doc: Dict[str, Any]) -> str:
+        """Load the extracted text of a document record"""
+        if doc.get("text_hash"):
+            return self.blobs.read(doc["text_hash"])
+        return doc.get("text_content") or ""
+
+    def delete_document(self, document_id: str) -> bool:
+        """Delete a document and its text blob once nothing else references it"""
+        doc = self.documents.get(document_id)
+        if doc is None or not self.documents.delete(document_id):
+            return False
+        text_hash = doc.get("text_hash")
+        if text_hash and not self.documents.find("text_hash", text_hash):
+            self.blobs.delete(text_hash)
+        return True
+
     def save_documents(self):
         """Save documents to file"""
-        return save_data(DOCUMENTS_FILE, self.documents)
-    
+        return self._save(self.documents)
+
     def save_summaries(self):
         """Save summaries to file"""
-        return save_data(SUMMARIES_FILE, self.summaries)
-    
+        return self._save(self.summaries)
+
     def save_flashcards(self):
         """Save flashcards to file"""
-        return save_data(FLASHCARDS_FILE, self.flashcards)
-    
+        return self._save(self.flashcards)
+
     def save_quizzes(self):
         """Save quizzes to file"""
-        return save_data(QUIZZES_FILE, self.quizzes)
-    
+        return self._save(self.quizzes)
+
     def save_chat_history(self):
         """Save chat history to file"""
-        return save_data(CHAT_HISTORY_FILE, self.chat_history)
-    
+        return self._save(self.chat_history)
+
     def save_study_plans(self):
         """Save study plans to file"""
-        return save_data(STUDY_PLANS_FILE, self.study_plans)
-    
+        return self._save(self.study_plans)
+
     def save_all(self):
         """Save all data to files"""
         return (
@@ -90,9 +956,17 @@ class Storage:
             self.save_study_plans()
         )
 
+    def close(self):
+        """Flush pending writes, release files and stop background work"""
+        if self._closed:
+            return
+        self._closed = True
+        if self.flusher is not None:
+            self.flusher.stop()
+        self.backend.close()
+
 
 # Global storage instance
 storage = Storage()
 
 
-
@@ -0,0 +1,446 @@
+"""Shared HTTP client for calls from the backend to the internal services
+
+Every call goes through the upstream's circuit breaker and carries the
+caller's remaining deadline in the X-Request-Timeout header. Idempotent
+calls are retried with jittered backoff while the retry budget allows,
+unless they timed out waiting for a response.
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from metrics import REQUEST_ID_HEADER, UPSTREAM_CIRCUIT_OPEN, UPSTREAM_LATENCY, UPSTREAM_RETRIES, request_id
+
+# Connection pool shared by every request to the document and AI services
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP2 = os.getenv("HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Circuit breaker: open after this many consecutive failures, probe again after the reset timeout
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# Retries of idempotent calls: at most RETRY_MAX_ATTEMPTS per call, and across
+# all calls at most RETRY_BUDGET_RATIO retries per request (plus RETRY_BUDGET_MIN)
+# within a sliding window, so retries cannot multiply load on a struggling service
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "2"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.1"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "2"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN = int(os.getenv("RETRY_BUDGET_MIN", "3"))
+RETRY_BUDGET_WINDOW = float(os.getenv("RETRY_BUDGET_WINDOW", "10"))
+RETRY_STATUSES = (502, 503, 504)
+
+# Seconds the caller is still willing to wait, sent to and read from every service
+DEADLINE_HEADER = "X-Request-Timeout"
+
+# Uploads are forwarded in chunks of this size instead of being buffered whole
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+
+class UpstreamUnavailable(httpx.TransportError):
+    """Raised without contacting an upstream whose circuit breaker is open"""
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """Raised when the caller's deadline has passed before a call could be made"""
+
+
+# Absolute deadline (time.monotonic()) of the request being handled, if the client sent one
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+def set_deadline(timeout_header: Optional[str]):
+    """Start the deadline for the current request from an X-Request-Timeout value"""
+    try:
+        seconds = float(timeout_header) if timeout_header else None
+    except ValueError:
+        seconds = None
+    if seconds is not None and seconds > 0:
+        request_deadline.set(time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """Fails calls fast while an upstream keeps failing
+
+    closed: calls pass, consecutive failures are counted.
+    open: calls fail immediately until reset_timeout has passed.
+    half-open: one probe call is let through; success closes the
+    circuit again, failure re-opens it. A probe that ends with neither
+    (cancelled, or out of time before it was sent) must call release().
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def check(self):
+        """Raise UpstreamUnavailable if a call may not be made right now"""
+        if self.state == "closed":
+            return
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half-open"
+            self._probing = False
+        if self.state == "half-open" and not self._probing:
+            self._probing = True
+            return
+        raise UpstreamUnavailable(f"{self.name} service unavailable (circuit {self.state})")
+
+    def release(self):
+        """Give back the half-open probe slot without a verdict"""
+        self._probing = False
+
+    def record_success(self):
+        UPSTREAM_CIRCUIT_OPEN.labels(self.name).set(0)
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"Circuit for {self.name} service opened after {self.failures} failures")
+            UPSTREAM_CIRCUIT_OPEN.labels(self.name).set(1)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """Caps retries to a fraction of recent requests (sliding window)"""
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, minimum: int = RETRY_BUDGET_MIN, window: float = RETRY_BUDGET_WINDOW):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self._requests: deque = deque()
+        self._retries: deque = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float):
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            self._requests.append(now)
+
+    def withdraw(self) -> bool:
+        """Take one retry from the budget; False if it is spent"""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            if len(self._retries) >= self.minimum + self.ratio * len(self._requests):
+                return False
+            self._retries.append(now)
+            return True
+
+
+class Upstream:
+    """An internal service the backend talks to"""
+
+    def __init__(self, name: str, base_url: str, timeout: float):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout_seconds = timeout
+        self.timeout = httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+        self.breaker = CircuitBreaker(name)
+        self.retry_budget = RetryBudget()
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def time_left(self, deadline: Optional[float] = None) -> float:
+        """Timeout for the next call: the service timeout, cut short by the deadline (the request's by default)"""
+        timeout = self.timeout_seconds
+        if deadline is None:
+            deadline = request_deadline.get()
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            raise DeadlineExceeded(f"Deadline exceeded before calling the {self.name} service")
+        return timeout
+
+    def call_options(self, deadline: Optional[float] = None) -> Dict[str, Any]:
+        """Per-call timeout, deadline header and request id"""
+        timeout = self.time_left(deadline)
+        headers = {DEADLINE_HEADER: f"{timeout:.3f}"}
+        if request_id.get():
+            headers[REQUEST_ID_HEADER] = request_id.get()
+        return {
+            "timeout": httpx.Timeout(timeout, connect=min(HTTP_CONNECT_TIMEOUT, timeout)),
+            "headers": headers,
+        }
+
+
+DOCUMENT_SERVICE = Upstream(
+    "document",
+    os.getenv("DOCUMENT_SERVICE_URL", "http://localhost:8001"),
+    float(os.getenv("DOCUMENT_SERVICE_TIMEOUT", "60")),
+)
+AI_SERVICE = Upstream(
+    "ai",
+    os.getenv("AI_SERVICE_URL", "http://localhost:8002"),
+    float(os.getenv("AI_SERVICE_TIMEOUT", "120")),
+)
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def http2_enabled() -> bool:
+    """HTTP/2 needs the optional h2 package"""
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        print("HTTP2 requested but the h2 package is not installed, using HTTP/1.1")
+        return False
+
+
+def create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=http2_enabled(),
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the application-wide client, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client()
+    return _client
+
+
+async def start():
+    get_client()
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def retry_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def timed_out(error: Optional[Exception]) -> bool:
+    """Whether a call reached the upstream but got no response in time"""
+    return isinstance(error, httpx.TimeoutException) and not isinstance(
+        error, (httpx.ConnectTimeout, httpx.PoolTimeout)
+    )
+
+
+def observe_call(service: Upstream, path: str, outcome: str, started: float):
+    UPSTREAM_LATENCY.labels(service.name, path, outcome).observe(time.perf_counter() - started)
+
+
+def record_response(service: Upstream, response: httpx.Response):
+    if response.status_code >= 500:
+        service.breaker.record_failure()
+    else:
+        service.breaker.record_success()
+
+
+async def send(
+    service: Upstream,
+    path: str,
+    request: Callable[[Dict[str, Any]], Awaitable[httpx.Response]],
+    idempotent: bool = False,
+) -> httpx.Response:
+    """Make a call through the breaker, retrying idempotent calls on transient errors
+
+    request is called with the per-attempt timeout and headers. All
+    attempts share one deadline: the request's, or else the service
+    timeout counted from the first attempt. Calls that timed out waiting
+    for a response are not retried, as the upstream may still be working
+    on them.
+    """
+    service.retry_budget.record_request()
+    deadline = request_deadline.get()
+    if deadline is None:
+        deadline = time.monotonic() + service.timeout_seconds
+    attempt = 0
+    while True:
+        service.breaker.check()
+        error = None
+        started = time.perf_counter()
+        try:
+            options = service.call_options(deadline)
+            response = await request(options)
+        except DeadlineExceeded:
+            # Out of time before sending; says nothing about the upstream
+            service.breaker.release()
+            raise
+        except httpx.TransportError as e:
+            observe_call(service, path, type(e).__name__, started)
+            service.breaker.record_failure()
+            error = e
+        except BaseException:
+            # Cancelled mid-call (client gone, batch cancelled)
+            service.breaker.release()
+            raise
+        else:
+            observe_call(service, path, str(response.status_code), started)
+            record_response(service, response)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+
+        delay = retry_delay(attempt)
+        retry = (
+            idempotent
+            and not timed_out(error)
+            and attempt < RETRY_MAX_ATTEMPTS
+            and time.monotonic() + delay < deadline
+            and service.retry_budget.withdraw()
+        )
+        if not retry:
+            if error is not None:
+                raise error
+            return response
+        UPSTREAM_RETRIES.labels(service.name).inc()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def post(service: Upstream, path: str, idempotent: bool = False, **kwargs) -> httpx.Response:
+    """POST to an upstream service over the shared connection pool
+
+    Pass idempotent=True for calls that are safe to repeat.
+    """
+    headers = kwargs.pop("headers", {})
+
+    async def request(options):
+        return await get_client().post(
+            service.url(path),
+            timeout=options["timeout"],
+            headers={**headers, **options["headers"]},
+            **kwargs,
+        )
+
+    return await send(service, path, request, idempotent)
+
+
+async def stream_ndjson(service: Upstream, path: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+    """POST to an upstream streaming endpoint and yield its NDJSON records as they arrive
+
+    Streams are not retried: records may already have been passed on.
+    """
+    service.breaker.check()
+    started = time.perf_counter()
+    outcome = "cancelled"
+    try:
+        options = service.call_options()
+        async with get_client().stream(
+            "POST", service.url(path),
+            timeout=options["timeout"],
+            headers={**kwargs.pop("headers", {}), **options["headers"]},
+            **kwargs,
+        ) as response:
+            outcome = str(response.status_code)
+            record_response(service, response)
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip():
+                    yield json.loads(line)
+    except DeadlineExceeded:
+        outcome = "DeadlineExceeded"
+        service.breaker.release()
+        raise
+    except httpx.TransportError as e:
+        outcome = type(e).__name__
+        service.breaker.record_failure()
+        raise
+    except BaseException:
+        # No verdict if cut short before the response (releasing after one is a no-op)
+        service.breaker.release()
+        raise
+    finally:
+        # Covers the whole stream, not just the time to the first byte
+        observe_call(service, path, outcome, started)
+
+
+async def post_file(
+    service: Upstream,
+    path: str,
+    field: str,
+    filename: str,
+    content_type: str,
+    chunks: AsyncIterator[bytes],
+    size: Optional[int] = None,
+) -> httpx.Response:
+    """POST a single file as multipart/form-data, streaming it chunk by chunk
+
+    When the file size is known the body gets an exact Content-Length,
+    otherwise it is sent with chunked transfer encoding.
+    """
+    boundary = uuid.uuid4().hex
+    safe_name = filename.replace('"', "%22").replace("\r", " ").replace("\n", " ")
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{safe_name}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    async def body():
+        yield head
+        async for chunk in chunks:
+            yield chunk
+        yield tail
+
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    if size is not None:
+        headers["Content-Length"] = str(len(head) + size + len(tail))
+
+    async def request(options):
+        return await get_client().post(
+            service.url(path),
+            content=body(),
+            headers={**headers, **options["headers"]},
+            timeout=options["timeout"],
+        )
+
+    # The body is a one-shot stream, so uploads are never retried
+    return await send(service, path, request)
+
+
+async def iter_upload(file, chunk_size: int = UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Read an UploadFile in fixed-size chunks"""
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,480 @@
+"""Load and latency benchmark for the backend
+
+Starts the stub AI/document services and the backend under uvicorn (in a
+scratch data directory), uploads a set of seed documents, then drives a
+weighted mix of operations at each concurrency level. Throughput and
+p50/p95/p99 latency per level and per operation are printed and written
+to a JSON file, so runs with different settings can be compared.
+
+    python benchmarks/run.py --concurrency 1,8,32 --requests 300 \\
+        --backend-env STORAGE_MODE=sqlite --output results/sqlite.json
+
+With --document-service real, uploads are generated PDFs (some pages
+without a text layer, see --scanned-ratio) processed by the actual
+document service.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+HERE = Path(__file__).resolve().parent
+REPO_ROOT = HERE.parent
+BACKEND_DIR = REPO_ROOT / "backend"
+
+DEFAULT_MIX = "upload=1,list=2,chat=3,chat_stream=1,summary=2,flashcards=1,quiz=1"
+
+WORDS = (
+    "the cell membrane regulates transport of ions and molecules through channels "
+    "proteins enzymes catalyse reactions lowering activation energy metabolism "
+    "respiration produces atp in mitochondria photosynthesis stores energy glucose"
+).split()
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise SystemExit(f"Unknown operation '{name}' (choose from {', '.join(OPERATIONS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, Optional[float]]:
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "p50": percentile(ms, 50),
+        "p95": percentile(ms, 95),
+        "p99": percentile(ms, 99),
+        "mean": sum(ms) / len(ms) if ms else None,
+        "max": max(ms) if ms else None,
+    }
+
+
+def document_text(rng: random.Random, size_kb: int) -> str:
+    """A lecture-like text document of roughly size_kb kilobytes"""
+    paragraphs, size = [], 0
+    while size < size_kb * 1024:
+        paragraph = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))).capitalize() + "."
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+
+def pdf_escape(line: str) -> str:
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def document_pdf(text: str, scanned_ratio: float, line_chars: int = 90, page_lines: int = 50) -> bytes:
+    """A minimal PDF of text, with a share of pages left without a text layer
+
+    "Scanned" pages carry only a short caption, so the document service
+    sends them to OCR. Which pages those are depends only on the text, so
+    a repeated upload is byte-for-byte identical.
+    """
+    words, lines, line = text.split(), [], ""
+    for word in words:
+        if line and len(line) + len(word) + 1 > line_chars:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    lines.append(line)
+    pages = [lines[i:i + page_lines] for i in range(0, len(lines), page_lines)]
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    pages = [["Figure"] if rng.random() < scanned_ratio else page for page in pages]
+
+    # Objects: 1 catalog, 2 page tree, 3 font, then a page and its content stream per page
+    objects = [b"", b"", b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in pages:
+        body = "BT /F1 10 Tf 12 TL 50 780 Td " + " ".join(f"({pdf_escape(l)}) ' " for l in page) + "ET"
+        stream = body.encode("latin-1", errors="replace")
+        objects.append(b"")
+        page_number = len(objects)
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects[page_number - 1] = (
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (page_number + 1)
+        )
+        kids.append(page_number)
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids)
+    )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+class Context:
+    """What the operations share: the client, the seeded documents and a generator"""
+
+    def __init__(self, client: httpx.AsyncClient, args, rng: random.Random):
+        self.client = client
+        self.args = args
+        self.rng = rng
+        self.document_ids: List[str] = []
+        self.uploaded_texts: List[str] = []
+
+    def document_id(self) -> str:
+        return self.rng.choice(self.document_ids)
+
+    def upload_body(self) -> str:
+        if self.uploaded_texts and self.rng.random() < self.args.duplicate_ratio:
+            return self.rng.choice(self.uploaded_texts)
+        text = document_text(self.rng, self.args.document_kb)
+        self.uploaded_texts.append(text)
+        return text
+
+
+async def op_upload(ctx: Context) -> httpx.Response:
+    name = f"lecture-{ctx.rng.randrange(10**6)}"
+    if ctx.args.document_service == "real":
+        # The real document service only takes PDF, DOCX and images
+        files = {"file": (f"{name}.pdf", document_pdf(ctx.upload_body(), ctx.args.scanned_ratio), "application/pdf")}
+    else:
+        files = {"file": (f"{name}.txt", ctx.upload_body().encode("utf-8"), "text/plain")}
+    return await ctx.client.post("/documents/upload", files=files)
+
+
+async def op_list(ctx: Context) -> httpx.Response:
+    return await ctx.client.get("/documents", params={"limit": 50})
+
+
+async def op_chat(ctx: Context) -> httpx.Response:
+    return await ctx.client.post("/ai/chat", json={
+        "message": f"Explain {ctx.rng.choice(WORDS)} in simple terms",
+        "document_ids": [ctx.document_id()],
+    })
+
+
+async def op_chat_stream(ctx: Context) -> httpx.Response:
+    body = {"message": f"How does {ctx.rng.choice(WORDS)} work?", "document_ids": [ctx.document_id()]}
+    async with ctx.client.stream("POST", "/ai/chat/stream", json=body) as response:
+        async for _ in response.aiter_bytes():
+            pass
+    return response
+
+
+async def op_summary(ctx: Context) -> httpx.Response:
+    return await ctx.client.post("/ai/summaries", json={"document_id": ctx.document_id()})
+
+
+async def op_flashcards(ctx: Context) -> httpx.Response:
+    return await ctx.client.post("/ai/flashcards", json={"document_id": ctx.document_id()})
+
+
+async def op_quiz(ctx: Context) -> httpx.Response:
+    return await ctx.client.post("/ai/quizzes", json={"document_id": ctx.document_id(), "question_count": 5})
+
+
+OPERATIONS = {
+    "upload": op_upload,
+    "list": op_list,
+    "chat": op_chat,
+    "chat_stream": op_chat_stream,
+    "summary": op_summary,
+    "flashcards": op_flashcards,
+    "quiz": op_quiz,
+}
+
+
+async def wait_for(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise SystemExit(f"Timed out waiting for {url}")
+            await asyncio.sleep(0.2)
+
+
+async def seed_documents(ctx: Context, count: int, timeout: float = 120):
+    """Upload the documents the other operations work on and wait until they are processed"""
+    for _ in range(count):
+        response = await op_upload(ctx)
+        response.raise_for_status()
+        ctx.document_ids.append(response.json()["id"])
+    deadline = time.monotonic() + timeout
+    pending = set(ctx.document_ids)
+    while pending:
+        for document_id in list(pending):
+            status = (await ctx.client.get(f"/documents/{document_id}/status")).json()["status"]
+            if status == "completed":
+                pending.discard(document_id)
+            elif status == "failed":
+                raise SystemExit(f"Seed document {document_id} failed to process")
+        if time.monotonic() > deadline:
+            raise SystemExit(f"{len(pending)} seed documents were not processed in time")
+        await asyncio.sleep(0.2)
+
+
+# Document service metrics kept in the results of runs against the real service
+DOCUMENT_METRICS = (
+    "extraction_stage_duration_seconds_sum",
+    "extraction_stage_duration_seconds_count",
+    "ocr_page_duration_seconds_sum",
+    "ocr_page_duration_seconds_count",
+    "extraction_cache_requests_total",
+)
+
+
+async def document_metrics(url: str) -> Dict[str, float]:
+    """Extraction timings and cache counts from the document service's /metrics"""
+    async with httpx.AsyncClient() as client:
+        text = (await client.get(url)).text
+    metrics = {}
+    for line in text.splitlines():
+        name, _, value = line.rpartition(" ")
+        if name.startswith(DOCUMENT_METRICS):
+            metrics[name] = float(value)
+    return metrics
+
+
+async def run_level(ctx: Context, concurrency: int, requests: int, mix: Dict[str, float]) -> dict:
+    """Run `requests` operations drawn from mix with `concurrency` workers"""
+    names = list(mix)
+    plan = ctx.rng.choices(names, weights=[mix[n] for n in names], k=requests)
+    samples: List[tuple] = []
+    queue: asyncio.Queue = asyncio.Queue()
+    for name in plan:
+        queue.put_nowait(name)
+
+    async def worker():
+        while True:
+            try:
+                name = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            try:
+                response = await OPERATIONS[name](ctx)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            samples.append((name, time.perf_counter() - started, ok))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - started
+
+    operations = {}
+    for name in names:
+        mine = [s for s in samples if s[0] == name]
+        if not mine:
+            continue
+        operations[name] = {
+            "count": len(mine),
+            "errors": sum(1 for s in mine if not s[2]),
+            "throughput_rps": len(mine) / duration,
+            "latency_ms": latency_summary([s[1] for s in mine if s[2]]),
+        }
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": sum(1 for s in samples if not s[2]),
+        "duration_s": duration,
+        "throughput_rps": len(samples) / duration,
+        "latency_ms": latency_summary([s[1] for s in samples if s[2]]),
+        "operations": operations,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_processes(args, data_dir: Path) -> List[subprocess.Popen]:
+    stubs = subprocess.Popen([
+        sys.executable, str(HERE / "stub_services.py"),
+        "--ai-port", str(args.ai_port),
+        "--document-port", str(args.document_port),
+        "--llm-latency-ms", str(args.llm_latency_ms),
+        "--llm-per-token-ms", str(args.llm_per_token_ms),
+        "--extract-latency-ms", str(args.extract_latency_ms),
+        "--document-service", args.document_service,
+        "--ocr-latency-ms", str(args.ocr_latency_ms),
+        *(["--stub-ocr"] if args.stub_ocr else []),
+    ], cwd=data_dir, env={**os.environ, **dict(item.split("=", 1) for item in args.document_env)})
+    env = {
+        **os.environ,
+        "AI_SERVICE_URL": f"http://127.0.0.1:{args.ai_port}",
+        "DOCUMENT_SERVICE_URL": f"http://127.0.0.1:{args.document_port}",
+        **dict(item.split("=", 1) for item in args.backend_env),
+    }
+    # The backend keeps its data under ./data, so it runs from the scratch directory
+    backend = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--app-dir", str(BACKEND_DIR),
+            "--host", "127.0.0.1",
+            "--port", str(args.backend_port),
+            "--log-level", "warning",
+        ],
+        cwd=data_dir,
+        env=env,
+    )
+    return [stubs, backend]
+
+
+async def benchmark(args) -> dict:
+    mix = parse_mix(args.mix)
+    levels = [int(c) for c in args.concurrency.split(",")]
+    base_url = f"http://127.0.0.1:{args.backend_port}"
+    started_at = datetime.now(timezone.utc).isoformat()
+    data_dir = Path(tempfile.mkdtemp(prefix="studybudds-bench-"))
+    processes = start_processes(args, data_dir)
+    try:
+        await wait_for(f"http://127.0.0.1:{args.ai_port}/health")
+        await wait_for(f"http://127.0.0.1:{args.document_port}/health")
+        await wait_for(f"{base_url}/")
+
+        limits = httpx.Limits(max_connections=max(levels) * 2, max_keepalive_connections=max(levels) * 2)
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            ctx = Context(client, args, random.Random(args.seed))
+            seed_started = time.perf_counter()
+            await seed_documents(ctx, args.seed_documents)
+            # Upload latency only covers accepting a file; this includes extracting it
+            seed_seconds = time.perf_counter() - seed_started
+            results = []
+            for concurrency in levels:
+                if args.warmup:
+                    await run_level(ctx, concurrency, args.warmup, mix)
+                level = await run_level(ctx, concurrency, args.requests, mix)
+                results.append(level)
+                print_level(level)
+        extraction = None
+        if args.document_service == "real":
+            extraction = await document_metrics(f"http://127.0.0.1:{args.document_port}/metrics")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    return {
+        "started_at": started_at,
+        "git_commit": git_commit(),
+        "config": {
+            "mix": mix,
+            "requests_per_level": args.requests,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "seed_documents": args.seed_documents,
+            "document_kb": args.document_kb,
+            "duplicate_ratio": args.duplicate_ratio,
+            "llm_latency_ms": args.llm_latency_ms,
+            "llm_per_token_ms": args.llm_per_token_ms,
+            "extract_latency_ms": args.extract_latency_ms,
+            "document_service": args.document_service,
+            "scanned_ratio": args.scanned_ratio,
+            "ocr_latency_ms": args.ocr_latency_ms if args.stub_ocr else None,
+            "document_env": dict(item.split("=", 1) for item in args.document_env),
+            "backend_env": dict(item.split("=", 1) for item in args.backend_env),
+            "data_dir": str(data_dir),
+        },
+        "seed_seconds": seed_seconds,
+        "document_metrics": extraction,
+        "levels": results,
+    }
+
+
+def print_level(level: dict):
+    def fmt(value):
+        return f"{value:8.1f}" if value is not None else "       -"
+
+    print(f"\nconcurrency {level['concurrency']}: {level['throughput_rps']:.1f} req/s, "
+          f"{level['errors']} errors in {level['requests']} requests")
+    print(f"  {'operation':<12} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = list(level["operations"].items()) + [("all", level)]
+    for name, stats in rows:
+        latency = stats["latency_ms"]
+        count = stats.get("count", stats.get("requests"))
+        print(f"  {name:<12} {count:>6} {stats['errors']:>6} {fmt(latency['p50'])} {fmt(latency['p95'])} {fmt(latency['p99'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests before each level")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation=weight pairs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-documents", type=int, default=10)
+    parser.add_argument("--document-kb", type=int, default=20, help="size of each uploaded document")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="share of uploads that repeat an earlier file")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-per-token-ms", type=float, default=0)
+    parser.add_argument("--extract-latency-ms", type=float, default=50)
+    parser.add_argument("--document-service", choices=("stub", "real"), default="stub",
+                        help="run the stub or the actual document service (which needs its requirements)")
+    parser.add_argument("--scanned-ratio", type=float, default=0.0,
+                        help="with the real document service, share of PDF pages without a text layer")
+    parser.add_argument("--stub-ocr", action="store_true",
+                        help="with the real document service, fake page rendering and tesseract")
+    parser.add_argument("--ocr-latency-ms", type=float, default=500, help="stubbed OCR time per page")
+    parser.add_argument("--document-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment for the document service, e.g. OCR_WORKERS=4 (repeatable)")
+    parser.add_argument("--backend-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment for the backend, e.g. STORAGE_MODE=sqlite (repeatable)")
+    parser.add_argument("--backend-port", type=int, default=18000)
+    parser.add_argument("--ai-port", type=int, default=18002)
+    parser.add_argument("--document-port", type=int, default=18001)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", default=None, help="JSON results file (default: benchmarks/results/<time>.json)")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    output = Path(args.output) if args.output else (
+        HERE / "results" / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""Stand-ins for the AI and document services, for benchmarking the backend
+
+Both apps run in one process. The AI stub answers every endpoint the
+backend uses with deterministic text derived from the request (no
+Gemini key needed) after a configurable delay. The document stub
+"extracts" uploads by decoding them as text; with --document-service real
+the actual document service (services/document) runs instead, so its
+extraction pipeline is measured too, optionally with OCR stubbed out.
+
+    python benchmarks/stub_services.py --ai-port 18002 --document-port 18001 --llm-latency-ms 300
+    python benchmarks/stub_services.py --document-service real --stub-ocr --ocr-latency-ms 400
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import uvicorn
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+DOCUMENT_SERVICE_DIR = Path(__file__).resolve().parent.parent / "services" / "document"
+
+WORDS = (
+    "cell energy membrane protein enzyme gradient transport signal pathway "
+    "molecule structure function process cycle system theory model equation "
+    "variable result evidence method analysis concept principle example"
+).split()
+
+
+class StubLLM:
+    """Deterministic text generator with a configurable latency
+
+    The same prompt always gives the same text. Latency is
+    latency_ms + per_token_ms per generated token, with +-jitter
+    drawn from a generator seeded by the prompt.
+    """
+
+    def __init__(self, latency_ms: float = 300, per_token_ms: float = 0, jitter: float = 0.1, tokens: int = 120):
+        self.latency_ms = latency_ms
+        self.per_token_ms = per_token_ms
+        self.jitter = jitter
+        self.tokens = tokens
+
+    def _rng(self, prompt: str) -> random.Random:
+        return random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+
+    def words(self, prompt: str, count: Optional[int] = None) -> List[str]:
+        rng = self._rng(prompt)
+        return [rng.choice(WORDS) for _ in range(count or self.tokens)]
+
+    def delay(self, prompt: str, tokens: int) -> float:
+        rng = self._rng(prompt + "#delay")
+        base = (self.latency_ms + self.per_token_ms * tokens) / 1000
+        return max(0.0, base * (1 + rng.uniform(-self.jitter, self.jitter)))
+
+    async def generate(self, prompt: str, count: Optional[int] = None) -> str:
+        words = self.words(prompt, count)
+        await asyncio.sleep(self.delay(prompt, len(words)))
+        return " ".join(words)
+
+    async def stream(self, prompt: str):
+        words = self.words(prompt)
+        step = self.delay(prompt, len(words)) / len(words)
+        for word in words:
+            await asyncio.sleep(step)
+            yield word + " "
+
+
+class GenerationRequest(BaseModel):
+    document_id: str
+    text_content: str
+    type: str = "lecture"
+    question_count: int = 10
+
+
+class DocumentsRequest(BaseModel):
+    message: str = ""
+    documents: List[dict]
+
+
+class IndexRequest(BaseModel):
+    document_id: str
+    text_content: str
+    filename: str = ""
+
+
+class IngestRequest(BaseModel):
+    id: str
+    content_hash: str
+    text_content: str
+    filename: str = ""
+
+
+def create_ai_app(llm: StubLLM) -> FastAPI:
+    app = FastAPI(title="AI Service (stub)")
+    # Content hashes the stub has been sent text for, like the real document store
+    known_hashes = set()
+
+    def check_documents(documents: List[dict]):
+        missing = [
+            d.get("id") for d in documents
+            if d.get("content_hash") and not d.get("text_content") and d["content_hash"] not in known_hashes
+        ]
+        if missing:
+            raise HTTPException(status_code=409, detail={"message": "Unknown document content", "missing": missing})
+
+    def ndjson(prompt: str, **final):
+        async def lines():
+            async for word in llm.stream(prompt):
+                yield json.dumps({"delta": word}) + "\n"
+            yield json.dumps({"done": True, **final}) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.post("/index")
+    async def index(request: IndexRequest):
+        known_hashes.add(hashlib.sha256(request.text_content.encode("utf-8")).hexdigest())
+        return {"document_id": request.document_id, "chunks": request.text_content.count("\n\n") + 1}
+
+    @app.post("/documents")
+    async def ingest(request: IngestRequest):
+        known_hashes.add(request.content_hash)
+        return {"id": request.id, "content_hash": request.content_hash}
+
+    @app.post("/summaries")
+    async def summaries(request: GenerationRequest):
+        return {"content": await llm.generate(f"summary:{request.type}:{request.text_content}")}
+
+    @app.post("/summaries/stream")
+    async def summaries_stream(request: GenerationRequest):
+        return ndjson(f"summary:{request.type}:{request.text_content}")
+
+    @app.post("/flashcards")
+    async def flashcards(request: GenerationRequest):
+        words = (await llm.generate(f"flashcards:{request.text_content}", 30)).split()
+        return {"flashcards": [{"front": f"What is {w}?", "back": f"{w} is a key term."} for w in words[:15]]}
+
+    @app.post("/quizzes")
+    async def quizzes(request: GenerationRequest):
+        words = (await llm.generate(f"quiz:{request.text_content}", request.question_count)).split()
+        return {"questions": [
+            {
+                "id": str(i + 1),
+                "question": f"Which statement about {w} is correct?",
+                "type": "mcq",
+                "options": [f"{w} A", f"{w} B", f"{w} C", f"{w} D"],
+                "correct_answer": f"{w} A",
+            }
+            for i, w in enumerate(words)
+        ]}
+
+    @app.post("/chat")
+    async def chat(request: DocumentsRequest):
+        check_documents(request.documents)
+        content = await llm.generate(f"chat:{request.message}")
+        return {"content": content, "citations": ["Document excerpt 1"]}
+
+    @app.post("/chat/stream")
+    async def chat_stream(request: DocumentsRequest):
+        check_documents(request.documents)
+        return ndjson(f"chat:{request.message}", citations=["Document excerpt 1"])
+
+    @app.post("/study-plans")
+    async def study_plans(request: DocumentsRequest):
+        check_documents(request.documents)
+        words = (await llm.generate("plan:" + ",".join(sorted(d["id"] for d in request.documents)), 6)).split()
+        ids = [d["id"] for d in request.documents]
+        return {"topics": [
+            {"id": str(i + 1), "name": w.title(), "difficulty": "medium", "priority": 5,
+             "estimated_time": 60, "document_ids": ids}
+            for i, w in enumerate(words)
+        ]}
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy", "service": "ai-stub"}
+
+    return app
+
+
+def create_document_app(latency_ms: float = 50, per_mb_ms: float = 200) -> FastAPI:
+    app = FastAPI(title="Document Processing Service (stub)")
+
+    @app.post("/process")
+    async def process(file: UploadFile = File(...)):
+        content = await file.read()
+        await asyncio.sleep((latency_ms + per_mb_ms * len(content) / (1024 * 1024)) / 1000)
+        text = content.decode("utf-8", errors="ignore")
+        if not text.strip():
+            raise HTTPException(status_code=400, detail="No text content could be extracted from the document")
+        return {
+            "id": hashlib.sha256(content).hexdigest()[:32],
+            "file_type": file.content_type or "text/plain",
+            "text_content": text,
+            "page_count": max(1, text.count("\f") + 1),
+        }
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy", "service": "document-stub"}
+
+    return app
+
+
+class StubImage:
+    """Stands in for a rendered page image"""
+
+    def __init__(self, page: int):
+        self.page = page
+
+    def close(self):
+        pass
+
+
+def stub_ocr(latency_ms: float):
+    """Replace page rendering (poppler) and tesseract with a fixed per-page delay
+
+    Rendering returns placeholder images and "recognising" one sleeps
+    (releasing the GIL, like a tesseract subprocess would) and returns a
+    line of text, so the real pipeline's scheduling is exercised without
+    either tool installed.
+    """
+    import extraction
+    import pytesseract
+
+    def convert_from_path(pdf_path, dpi=None, first_page=1, last_page=None, **kwargs):
+        return [StubImage(page) for page in range(first_page, (last_page or first_page) + 1)]
+
+    def image_to_string(image, *args, **kwargs):
+        time.sleep(latency_ms / 1000)
+        return f"Scanned page {getattr(image, 'page', 1)} " + " ".join(WORDS[:20])
+
+    extraction.convert_from_path = convert_from_path
+    pytesseract.image_to_string = image_to_string
+
+
+def create_real_document_app(stub_ocr_latency_ms: Optional[float] = None) -> FastAPI:
+    """The actual document service app, imported from services/document"""
+    sys.path.insert(0, str(DOCUMENT_SERVICE_DIR))
+    import main as document_service
+
+    if stub_ocr_latency_ms is not None:
+        stub_ocr(stub_ocr_latency_ms)
+    return document_service.app
+
+
+async def serve(args):
+    llm = StubLLM(args.llm_latency_ms, args.llm_per_token_ms, args.llm_jitter)
+    if args.document_service == "real":
+        document_app = create_real_document_app(args.ocr_latency_ms if args.stub_ocr else None)
+    else:
+        document_app = create_document_app(args.extract_latency_ms, args.extract_per_mb_ms)
+    servers = [
+        uvicorn.Server(uvicorn.Config(create_ai_app(llm), host=args.host, port=args.ai_port, log_level="warning")),
+        uvicorn.Server(uvicorn.Config(
+            document_app, host=args.host, port=args.document_port, log_level="warning",
+        )),
+    ]
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ai-port", type=int, default=18002)
+    parser.add_argument("--document-port", type=int, default=18001)
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-per-token-ms", type=float, default=0)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--extract-latency-ms", type=float, default=50)
+    parser.add_argument("--extract-per-mb-ms", type=float, default=200)
+    parser.add_argument("--document-service", choices=("stub", "real"), default="stub",
+                        help="stub decodes uploads as text; real runs services/document (needs its requirements)")
+    parser.add_argument("--stub-ocr", action="store_true",
+                        help="with the real document service, fake page rendering and tesseract")
+    parser.add_argument("--ocr-latency-ms", type=float, default=500, help="stubbed OCR time per page")
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
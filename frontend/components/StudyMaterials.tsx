@@ -108,6 +108,8 @@ export default function StudyMaterials() {
   }
 
   const selectedDocument = documents.find(d => d.id === selectedDoc)
+  // Re-uploads of the same file share the study materials of the original
+  const materialsDocId = selectedDocument?.source_document_id ?? selectedDoc
 
   if (loading) {
     return (
@@ -220,7 +222,7 @@ export default function StudyMaterials() {
             </div>
 
             {/* Summaries */}
-            {summaries.filter(s => s.document_id === selectedDoc).length > 0 && (
+            {summaries.filter(s => s.document_id === materialsDocId).length > 0 && (
               <div className="card-elevated">
                 <h3 className="text-xl font-bold mb-6 text-neutral-900 flex items-center space-x-2">
                   <Sparkles className="h-6 w-6 text-primary" />
@@ -228,7 +230,7 @@ export default function StudyMaterials() {
                 </h3>
                 <div className="space-y-4">
                   {summaries
-                    .filter(s => s.document_id === selectedDoc)
+                    .filter(s => s.document_id === materialsDocId)
                     .map(summary => (
                       <div key={summary.id} className="p-6 bg-gradient-to-br from-primary-50 to-primary-100 rounded-xl border border-primary-200">
                         <p className="whitespace-pre-wrap text-neutral-900 leading-relaxed">{summary.content}</p>
@@ -242,7 +244,7 @@ export default function StudyMaterials() {
             )}
 
             {/* Flashcards */}
-            {flashcards.filter(f => f.document_id === selectedDoc).length > 0 && (
+            {flashcards.filter(f => f.document_id === materialsDocId).length > 0 && (
               <div className="card-elevated">
                 <h3 className="text-xl font-bold mb-6 text-neutral-900 flex items-center space-x-2">
                   <Brain className="h-6 w-6 text-primary" />
@@ -250,7 +252,7 @@ export default function StudyMaterials() {
                 </h3>
                 <div className="grid grid-cols-1 md:grid-cols-2 gap-4">
                   {flashcards
-                    .filter(f => f.document_id === selectedDoc)
+                    .filter(f => f.document_id === materialsDocId)
                     .map(card => (
                       <div
                         key={card.id}
@@ -265,7 +267,7 @@ export default function StudyMaterials() {
             )}
 
             {/* Quizzes */}
-            {quizzes.filter(q => q.document_id === selectedDoc).length > 0 && (
+            {quizzes.filter(q => q.document_id === materialsDocId).length > 0 && (
               <div className="card-elevated">
                 <h3 className="text-xl font-bold mb-6 text-neutral-900 flex items-center space-x-2">
                   <BookOpen className="h-6 w-6 text-primary" />
@@ -273,7 +275,7 @@ export default function StudyMaterials() {
                 </h3>
                 <div className="space-y-6">
                   {quizzes
-                    .filter(q => q.document_id === selectedDoc)
+                    .filter(q => q.document_id === materialsDocId)
                     .map(quiz => (
                       <div key={quiz.id} className="space-y-4">
                         {quiz.questions.map((q, idx) => (
@@ -45,9 +45,15 @@ export interface Document {
   filename: string
   file_type: string
   upload_date: string
-  status: 'processing' | 'completed' | 'failed'
+  status: 'queued' | 'processing' | 'completed' | 'failed'
+  job_id?: string
+  stage?: string
+  progress?: number
+  error?: string
   text_content?: string
   page_count?: number
+  file_hash?: string
+  source_document_id?: string
 }
 
 export interface Summary {
@@ -1,9 +1,19 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Iterator, List, Optional
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import google.generativeai as genai
+import hashlib
+import json
 import os
+import re
+import tempfile
+import time
+from pathlib import Path
 from dotenv import load_dotenv
 import chromadb
 from chromadb.config import Settings
@@ -21,6 +31,111 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Metrics, served at /metrics in the Prometheus text format
+REQUEST_ID_HEADER = "X-Request-ID"
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "2"))
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request, by route template",
+    ["method", "route", "status"],
+)
+GEMINI_LATENCY = Histogram(
+    "gemini_request_duration_seconds",
+    "Time of Gemini generation calls (whole stream for streamed calls)",
+    ["mode", "outcome"],
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+GEMINI_TOKENS = Counter(
+    "gemini_tokens_total",
+    "Gemini tokens used, from usage metadata or estimated at 4 characters per token",
+    ["kind"],
+)
+CHROMA_LATENCY = Histogram(
+    "chroma_operation_duration_seconds",
+    "Time of ChromaDB operations",
+    ["operation"],
+)
+
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Time each request and echo its X-Request-ID (from the backend) back"""
+    rid = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers[REQUEST_ID_HEADER] = rid
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        REQUEST_LATENCY.labels(request.method, route, str(status)).observe(elapsed)
+        if elapsed >= SLOW_REQUEST_SECONDS:
+            print(f"Slow request {rid}: {request.method} {route} -> {status} in {elapsed:.3f}s")
+
+
+def count_tokens(prompt: str, text: str, usage=None):
+    """Add a call's prompt and completion tokens to GEMINI_TOKENS"""
+    prompt_tokens = getattr(usage, "prompt_token_count", None)
+    completion_tokens = getattr(usage, "candidates_token_count", None)
+    GEMINI_TOKENS.labels("prompt").inc(prompt_tokens if prompt_tokens is not None else len(prompt) // 4)
+    GEMINI_TOKENS.labels("completion").inc(completion_tokens if completion_tokens is not None else len(text) // 4)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+# Seconds the caller is still willing to wait, set by the backend on every call
+DEADLINE_HEADER = "X-Request-Timeout"
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+@app.middleware("http")
+async def read_deadline(request: Request, call_next):
+    """Remember when the caller will stop waiting for this request"""
+    try:
+        timeout = float(request.headers.get(DEADLINE_HEADER, ""))
+    except ValueError:
+        timeout = None
+    if timeout is not None and timeout > 0:
+        request_deadline.set(time.monotonic() + timeout)
+    return await call_next(request)
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Seconds until the deadline; raises 504 if it has already passed"""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+    return remaining
+
+
+# google-generativeai 0.3.2 has no per-call timeout, so calls with a deadline
+# run on these threads and are abandoned (left to finish) once it passes
+GEMINI_THREADS = int(os.getenv("GEMINI_THREADS", "16"))
+_gemini_pool = ThreadPoolExecutor(max_workers=GEMINI_THREADS, thread_name_prefix="gemini")
+
+
+def with_deadline(fn, deadline: Optional[float]):
+    """Run a blocking Gemini call, raising 504 if the deadline passes first"""
+    remaining = time_left(deadline)
+    if remaining is None:
+        return fn()
+    future = _gemini_pool.submit(fn)
+    try:
+        return future.result(timeout=remaining)
+    except FuturesTimeoutError:
+        future.cancel()
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+
+
 # Initialize Gemini
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
@@ -40,6 +155,11 @@ try:
 except:
     collection = chroma_client.create_collection(name="study_documents")
 
+# Ingested document text, stored by content hash so the backend can send
+# references ({id, content_hash}) instead of full text on every request
+DOCUMENT_STORE_DIR = Path(os.getenv("DOCUMENT_STORE_DIR", "./document_store"))
+DOCUMENT_STORE_DIR.mkdir(exist_ok=True)
+
 
 class SummaryRequest(BaseModel):
     document_id: str
@@ -67,20 +187,174 @@ class StudyPlanRequest(BaseModel):
     documents: List[dict]
 
 
+class IndexRequest(BaseModel):
+    document_id: str
+    text_content: str
+    filename: str = ""
+
+
+class IngestRequest(BaseModel):
+    id: str
+    content_hash: str
+    text_content: str
+    filename: str = ""
+
+
 def generate_with_gemini(prompt: str, max_tokens: int = 2000) -> str:
     """Generate content using Gemini"""
+    # Skip the call entirely when nobody is waiting for the answer any more
+    deadline = request_deadline.get()
+    time_left(deadline)
+    started = time.perf_counter()
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        response = with_deadline(lambda: model.generate_content(prompt), deadline)
+        text = response.text
+    except HTTPException:
+        GEMINI_LATENCY.labels("generate", "timeout").observe(time.perf_counter() - started)
+        raise
     except Exception as e:
+        GEMINI_LATENCY.labels("generate", "error").observe(time.perf_counter() - started)
         raise HTTPException(status_code=500, detail=f"Gemini API error: {str(e)}")
+    GEMINI_LATENCY.labels("generate", "ok").observe(time.perf_counter() - started)
+    count_tokens(prompt, text, getattr(response, "usage_metadata", None))
+    return text
+
+
+def stream_with_gemini(prompt: str, deadline: Optional[float] = None) -> Iterator[str]:
+    """Yield generated text from Gemini as it arrives, until the deadline"""
+    response = with_deadline(lambda: model.generate_content(prompt, stream=True), deadline)
+    started = time.perf_counter()
+    outcome = "error"
+    parts = []
+    chunks = iter(response)
+    try:
+        while True:
+            # Each wait for the next chunk is bounded by the deadline too
+            chunk = with_deadline(lambda: next(chunks, None), deadline)
+            if chunk is None:
+                break
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. safety metadata only)
+                continue
+            if text:
+                parts.append(text)
+                yield text
+        outcome = "ok"
+    finally:
+        GEMINI_LATENCY.labels("stream", outcome).observe(time.perf_counter() - started)
+        count_tokens(prompt, "".join(parts), getattr(response, "usage_metadata", None))
+
+
+def ndjson_stream(prompt: str, on_complete=None, deadline: Optional[float] = None, **final) -> Iterator[str]:
+    """Stream a generation as NDJSON: {"delta": ...} lines then {"done": true, ...}
+
+    Runs in the threadpool (StreamingResponse iterates sync generators
+    there), so the blocking Gemini iterator does not stall the event loop.
+    The request deadline is passed in because it is read from the request
+    context, which the threadpool does not see.
+    """
+    parts = []
+    try:
+        for text in stream_with_gemini(prompt, deadline):
+            parts.append(text)
+            yield json.dumps({"delta": text}) + "\n"
+    except HTTPException as e:
+        yield json.dumps({"error": e.detail}) + "\n"
+        return
+    except Exception as e:
+        yield json.dumps({"error": f"Gemini API error: {str(e)}"}) + "\n"
+        return
+    if on_complete is not None:
+        on_complete("".join(parts))
+    yield json.dumps({"done": True, **final}) + "\n"
+
+
+# Content hashes name files in DOCUMENT_STORE_DIR, so only real sha256 digests are accepted
+CONTENT_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def store_document_text(text: str) -> str:
+    """Save document text under its content hash, returns the hash"""
+    text_hash = content_hash(text)
+    path = DOCUMENT_STORE_DIR / f"{text_hash}.txt"
+    if not path.exists():
+        # A temp file per call, so concurrent stores of one text do not collide
+        fd, tmp_name = tempfile.mkstemp(dir=DOCUMENT_STORE_DIR, prefix=path.name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_name, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+    return text_hash
+
+
+def load_document_text(text_hash: str, limit: int) -> Optional[str]:
+    """Read up to limit characters of a stored document, None if unknown"""
+    if not CONTENT_HASH_PATTERN.match(text_hash):
+        return None
+    path = DOCUMENT_STORE_DIR / f"{text_hash}.txt"
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read(limit)
+    except (IOError, ValueError):
+        return None
+
+
+def resolve_documents(documents: List[dict], limit: int) -> List[dict]:
+    """Fill in text_content (first limit chars) for documents sent by reference
+
+    Documents may carry their text inline or only a content_hash. If any
+    hash is unknown, respond 409 listing the missing document ids so the
+    caller can upload them via POST /documents and retry. A content_hash
+    that is not a sha256 hex digest is a 400.
+    """
+    invalid = [
+        doc.get("id") for doc in documents
+        if not doc.get("text_content") and doc.get("content_hash")
+        and not CONTENT_HASH_PATTERN.match(str(doc["content_hash"]))
+    ]
+    if invalid:
+        raise HTTPException(
+            status_code=400,
+            detail={"message": "Invalid content_hash", "documents": invalid},
+        )
+    
+    resolved, missing = [], []
+    for doc in documents:
+        if doc.get("text_content"):
+            resolved.append({**doc, "text_content": doc["text_content"][:limit]})
+            continue
+        text = load_document_text(doc["content_hash"], limit) if doc.get("content_hash") else None
+        if text is None and doc.get("content_hash"):
+            missing.append(doc.get("id"))
+            continue
+        resolved.append({**doc, "text_content": text or ""})
+    if missing:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Unknown document content", "missing": missing},
+        )
+    return resolved
 
 
-def store_document_embeddings(document_id: str, text_content: str, filename: str):
+def store_document_embeddings(document_id: str, text_content: str, filename: str) -> int:
     """Store document chunks in vector database"""
     # Simple chunking (can be improved)
     chunks = text_content.split("\n\n")
     chunks = [chunk.strip() for chunk in chunks if len(chunk.strip()) > 50]
+    if not chunks:
+        return 0
     
     ids = [f"{document_id}_{i}" for i in range(len(chunks))]
     metadatas = [
@@ -88,20 +362,23 @@ def store_document_embeddings(document_id: str, text_content: str, filename: str
         for i in range(len(chunks))
     ]
     
-    collection.add(
-        documents=chunks,
-        ids=ids,
-        metadatas=metadatas,
-    )
+    with CHROMA_LATENCY.labels("add").time():
+        collection.add(
+            documents=chunks,
+            ids=ids,
+            metadatas=metadatas,
+        )
+    return len(chunks)
 
 
 def retrieve_relevant_chunks(query: str, n_results: int = 5) -> List[str]:
     """Retrieve relevant document chunks using RAG"""
     try:
-        results = collection.query(
-            query_texts=[query],
-            n_results=n_results,
-        )
+        with CHROMA_LATENCY.labels("query").time():
+            results = collection.query(
+                query_texts=[query],
+                n_results=n_results,
+            )
         if results["documents"] and len(results["documents"]) > 0:
             return results["documents"][0]
         return []
@@ -110,9 +387,26 @@ def retrieve_relevant_chunks(query: str, n_results: int = 5) -> List[str]:
         return []
 
 
-@app.post("/summaries")
-async def generate_summary(request: SummaryRequest):
-    """Generate a summary for a document"""
+@app.post("/documents")
+async def ingest_document(request: IngestRequest):
+    """Store document text so later requests can reference it by hash"""
+    if content_hash(request.text_content) != request.content_hash:
+        raise HTTPException(status_code=400, detail="content_hash does not match text_content")
+    store_document_text(request.text_content)
+    return {"id": request.id, "content_hash": request.content_hash}
+
+
+@app.post("/index")
+async def index_document(request: IndexRequest):
+    """Store a newly extracted document for reference and retrieval"""
+    text_hash = store_document_text(request.text_content)
+    chunk_count = store_document_embeddings(
+        request.document_id, request.text_content, request.filename or f"doc_{request.document_id}"
+    )
+    return {"document_id": request.document_id, "content_hash": text_hash, "chunks": chunk_count}
+
+
+def build_summary_prompt(request: SummaryRequest) -> str:
     summary_type_prompts = {
         "exam": "Create a comprehensive exam-focused summary highlighting key concepts, definitions, and important facts.",
         "lecture": "Create a structured lecture summary with main topics, key points, and important details.",
@@ -127,8 +421,13 @@ async def generate_summary(request: SummaryRequest):
     
     Generate a well-structured summary:
     """
-    
-    content = generate_with_gemini(prompt_template)
+    return prompt_template
+
+
+@app.post("/summaries")
+async def generate_summary(request: SummaryRequest):
+    """Generate a summary for a document"""
+    content = generate_with_gemini(build_summary_prompt(request))
     
     # Store embeddings for RAG
     store_document_embeddings(request.document_id, request.text_content, f"doc_{request.document_id}")
@@ -136,6 +435,18 @@ async def generate_summary(request: SummaryRequest):
     return {"content": content}
 
 
+@app.post("/summaries/stream")
+async def stream_summary(request: SummaryRequest):
+    """Generate a summary, streaming tokens as NDJSON"""
+    def on_complete(content: str):
+        store_document_embeddings(request.document_id, request.text_content, f"doc_{request.document_id}")
+    
+    return StreamingResponse(
+        ndjson_stream(build_summary_prompt(request), on_complete, deadline=request_deadline.get()),
+        media_type="application/x-ndjson",
+    )
+
+
 @app.post("/flashcards")
 async def generate_flashcards(request: FlashcardRequest):
     """Generate flashcards for a document"""
@@ -246,9 +557,8 @@ async def generate_quiz(request: QuizRequest):
         return {"questions": questions[:request.question_count]}
 
 
-@app.post("/chat")
-async def chat(request: ChatRequest):
-    """Chat with AI using RAG"""
+def build_chat_prompt(request: ChatRequest) -> tuple[str, List[str]]:
+    """Build the RAG prompt for a chat message and the citations it draws on"""
     # Retrieve relevant chunks
     relevant_chunks = retrieve_relevant_chunks(request.message, n_results=5)
     
@@ -260,9 +570,10 @@ async def chat(request: ChatRequest):
         context = "\n\nRelevant context from your documents:\n" + "\n\n".join(relevant_chunks[:3])
         citations = [f"Document excerpt {i+1}" for i in range(min(3, len(relevant_chunks)))]
     
-    # Also include full document content if available
+    # Also include the beginning of the first two documents that have text
+    with_text = [doc for doc in request.documents if doc.get("text_content") or doc.get("content_hash")]
     doc_texts = []
-    for doc in request.documents:
+    for doc in resolve_documents(with_text[:2], limit=2000):
         if doc.get("text_content"):
             doc_texts.append(f"From {doc.get('filename', 'document')}:\n{doc['text_content'][:2000]}")
     
@@ -280,20 +591,36 @@ async def chat(request: ChatRequest):
     
     Provide a clear, helpful answer. If you reference specific information, mention which document it came from.
     """
-    
+    return prompt, citations if citations else ["General knowledge"]
+
+
+@app.post("/chat")
+async def chat(request: ChatRequest):
+    """Chat with AI using RAG"""
+    prompt, citations = build_chat_prompt(request)
     content = generate_with_gemini(prompt)
     
     return {
         "content": content,
-        "citations": citations if citations else ["General knowledge"],
+        "citations": citations,
     }
 
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Chat with AI using RAG, streaming tokens as NDJSON"""
+    prompt, citations = build_chat_prompt(request)
+    return StreamingResponse(
+        ndjson_stream(prompt, deadline=request_deadline.get(), citations=citations),
+        media_type="application/x-ndjson",
+    )
+
+
 @app.post("/study-plans")
 async def generate_study_plan(request: StudyPlanRequest):
     """Generate a personalized study plan"""
     doc_summaries = []
-    for doc in request.documents:
+    for doc in resolve_documents(request.documents, limit=1000):
         summary = f"Document: {doc.get('filename', 'Unknown')}\n"
         summary += f"Content preview: {doc.get('text_content', '')[:1000]}"
         doc_summaries.append(summary)
@@ -0,0 +1,133 @@
+"""On-disk cache of extraction results, keyed on the uploaded file's content"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from prometheus_client import Counter
+
+from extraction import OCR_DPI, OCR_MIN_TEXT_DENSITY, ocr_available
+
+EXTRACTION_CACHE_DIR = Path(os.getenv("EXTRACTION_CACHE_DIR", "./extraction_cache"))
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Bump when extraction changes so older results are not reused
+EXTRACTOR_VERSION = os.getenv("EXTRACTOR_VERSION", "1")
+
+EXTRACTION_CACHE = Counter(
+    "extraction_cache_requests_total",
+    "Extraction cache lookups",
+    ["result"],
+)
+
+
+def cache_key(file_content: bytes, file_type: str) -> str:
+    """Key for one extraction: file bytes, file type, extractor version, OCR settings and
+    whether OCR is installed (results made without it are replaced once it is)"""
+    material = json.dumps(
+        {
+            "file_hash": hashlib.sha256(file_content).hexdigest(),
+            "file_type": file_type,
+            "extractor_version": EXTRACTOR_VERSION,
+            "ocr_dpi": OCR_DPI,
+            "ocr_min_text_density": OCR_MIN_TEXT_DENSITY,
+            "ocr_available": ocr_available(),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def atomic_write(file_path: Path, payload: bytes):
+    """Write a file via a fsync'd temp file and an atomic rename
+
+    The temp file is unique to the writing thread, so concurrent uploads of
+    the same file cannot interleave their writes.
+    """
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+class ExtractionCache:
+    """LRU cache of per-page extraction records, bounded by total size on disk
+
+    Every entry is its own file (``<key>.json``). Recency and sizes are
+    kept in memory and recency is mirrored in the file mtimes, which
+    restore the LRU order after a restart.
+    """
+
+    def __init__(self, directory: Path = EXTRACTION_CACHE_DIR, max_bytes: int = EXTRACTION_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        for path in self.directory.glob("*.tmp"):
+            # Left behind by a write that did not finish
+            path.unlink(missing_ok=True)
+        files = sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            size = path.stat().st_size
+            self._entries[path.stem] = size
+            self._size += size
+        self._evict()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self._path(key).unlink(missing_ok=True)
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """Return the cached page records, or None if missing"""
+        with self._lock:
+            if key not in self._entries:
+                EXTRACTION_CACHE.labels("miss").inc()
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                pages = json.load(f)["pages"]
+        except (IOError, KeyError, json.JSONDecodeError):
+            self.discard(key)
+            EXTRACTION_CACHE.labels("miss").inc()
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        EXTRACTION_CACHE.labels("hit").inc()
+        return pages
+
+    def put(self, key: str, pages: List[Dict[str, Any]]):
+        """Store the page records of a file, evicting the least recently used entries"""
+        payload = json.dumps({"pages": pages}, ensure_ascii=False).encode("utf-8")
+        try:
+            atomic_write(self._path(key), payload)
+        except (IOError, OSError) as e:
+            print(f"Error writing extraction cache entry {key}: {e}")
+            return
+        with self._lock:
+            self._size += len(payload) - self._entries.get(key, 0)
+            self._entries[key] = len(payload)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def discard(self, key: str):
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+        self._path(key).unlink(missing_ok=True)
+
+
+extraction_cache = ExtractionCache()
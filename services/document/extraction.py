@@ -0,0 +1,373 @@
+"""Parallel PDF text extraction and OCR for the document processing service
+
+PDF pages are split into contiguous ranges that are extracted in a pool
+of worker processes (PyPDF2 is pure Python, so threads would serialize on
+the GIL); pages are handed back, numbered, as each range finishes.
+
+Pages with too little text for their size that have no text layer or
+draw an image (scans, figures) are rasterized a few at a time and OCR'd
+by a pool of threads (each tesseract run is its own process, so threads
+are enough), with a process-wide cap on how many page images exist at
+once.
+"""
+import asyncio
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import PyPDF2
+import pytesseract
+from pdf2image import convert_from_path
+from prometheus_client import Histogram
+from starlette.concurrency import run_in_threadpool
+
+# Worker processes for PDF text extraction, shared by all requests
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+# Smaller PDFs are extracted by a single worker; splitting them costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16"))
+
+# OCR: rasterization resolution, concurrent tesseract runs, pages rendered per
+# pdftoppm call and the most page images allowed in memory at once
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(EXTRACT_WORKERS)))
+OCR_WINDOW = int(os.getenv("OCR_WINDOW", "4"))
+OCR_MAX_LIVE_PAGES = int(os.getenv("OCR_MAX_LIVE_PAGES", str(max(OCR_WINDOW, 2 * OCR_WORKERS))))
+# Pages whose text layer has fewer non-space characters per square inch are
+# OCR'd if they have no text layer at all or draw an image (a full page of
+# text is ~25, a caption-only scan well under 1)
+OCR_MIN_TEXT_DENSITY = float(os.getenv("OCR_MIN_TEXT_DENSITY", "2"))
+
+EXTRACTION_STAGE = Histogram(
+    "extraction_stage_duration_seconds",
+    "Time spent in each extraction stage of a document",
+    ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+OCR_PAGE = Histogram(
+    "ocr_page_duration_seconds",
+    "Time to OCR a single page or image",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32),
+)
+
+# on_page(page number, text, seconds), called as each OCR'd page finishes
+PageCallback = Callable[[int, str, float], None]
+
+
+class LivePages:
+    """Process-wide count of rendered page images, capped at a limit
+
+    A whole window's worth of slots is taken at once, so concurrent
+    documents can never each hold part of the budget while waiting for the
+    rest of it.
+    """
+
+    def __init__(self, limit: int):
+        self.available = limit
+        self._cond = threading.Condition()
+
+    def acquire(self, count: int = 1):
+        with self._cond:
+            self._cond.wait_for(lambda: self.available >= count)
+            self.available -= count
+
+    def release(self, count: int = 1):
+        with self._cond:
+            self.available += count
+            self._cond.notify_all()
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_ocr_pool: Optional[ThreadPoolExecutor] = None
+# Shared by every ocr_pages call, so the cap holds across concurrent uploads
+_live_pages = LivePages(OCR_MAX_LIVE_PAGES)
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: forking a process that runs an event loop and threads is unsafe
+        _pool = ProcessPoolExecutor(
+            max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+def drop_pool(pool: ProcessPoolExecutor):
+    """Forget a broken pool (a worker died, e.g. killed for memory) so the next call starts a new one"""
+    global _pool
+    if _pool is pool:
+        _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_in_pool(fn, *args):
+    """Run fn in the process pool, retrying once on a fresh pool if the pool broke"""
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = get_pool()
+        try:
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            print("PDF extraction worker died, restarting the process pool")
+            drop_pool(pool)
+            if attempt:
+                raise
+
+
+def get_ocr_pool() -> ThreadPoolExecutor:
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+    return _ocr_pool
+
+
+def shutdown_pool():
+    global _pool, _ocr_pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+    if _ocr_pool is not None:
+        _ocr_pool.shutdown(cancel_futures=True)
+        _ocr_pool = None
+
+
+@lru_cache(maxsize=None)
+def ocr_available() -> bool:
+    """Whether the tools OCR needs, poppler's pdftoppm and tesseract, are installed"""
+    return bool(shutil.which("pdftoppm") and shutil.which(pytesseract.pytesseract.tesseract_cmd))
+
+
+class PageText(NamedTuple):
+    """Text layer of one PDF page, the page's area in square inches, the
+    time taken to extract it and whether the page draws any images"""
+    text: str
+    area: float
+    seconds: float = 0.0
+    has_images: bool = False
+
+    def density(self) -> float:
+        chars = sum(1 for c in self.text if not c.isspace())
+        return chars / self.area if self.area > 0 else float(chars)
+
+    def needs_ocr(self) -> bool:
+        """Sparse pages are OCR'd only if they could hold text the layer lacks
+
+        A short last page or a title page has little text but no image for
+        OCR to read more from; a scan has no text layer, or an image.
+        """
+        if self.density() >= OCR_MIN_TEXT_DENSITY:
+            return False
+        return not self.text.strip() or self.has_images
+
+
+def count_pages(file_content: bytes) -> int:
+    return len(PyPDF2.PdfReader(io.BytesIO(file_content)).pages)
+
+
+def has_images(resources, depth: int = 0) -> bool:
+    """Whether page resources include an image XObject, directly or in a form drawn on the page"""
+    if resources is None or depth > 8:
+        return False
+    xobjects = resources.get_object().get("/XObject")
+    if xobjects is None:
+        return False
+    for xobject in xobjects.get_object().values():
+        xobject = xobject.get_object()
+        subtype = xobject.get("/Subtype")
+        if subtype == "/Image":
+            return True
+        if subtype == "/Form" and has_images(xobject.get("/Resources"), depth + 1):
+            return True
+    return False
+
+
+def extract_page_range(file_content: bytes, start: int, end: int) -> List[PageText]:
+    """Text of pages [start, end) of a PDF; runs in a worker process"""
+    reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+    pages = []
+    for i in range(start, end):
+        started = time.perf_counter()
+        page = reader.pages[i]
+        box = page.mediabox
+        area = float(box.width) * float(box.height) / (72 * 72)
+        text = page.extract_text() or ""
+        try:
+            images = has_images(page.get("/Resources"))
+        except Exception:
+            # Unreadable resources: let the density decide, as for a scan
+            images = True
+        pages.append(PageText(text, area, time.perf_counter() - started, images))
+    return pages
+
+
+def page_ranges(page_count: int, workers: int) -> List[tuple[int, int]]:
+    """Split pages into at most `workers` contiguous, near-equal ranges"""
+    if page_count < PDF_PARALLEL_MIN_PAGES:
+        workers = 1
+    workers = max(1, min(workers, page_count))
+    size, extra = divmod(page_count, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+async def iter_pdf_pages(file_content: bytes) -> AsyncIterator[Tuple[int, PageText]]:
+    """(page number, text layer) of every page of a PDF, extracted in the
+    process pool; each range's pages are yielded as soon as it finishes"""
+    async def extract_range(start: int, end: int) -> Tuple[int, List[PageText]]:
+        return start, await run_in_pool(extract_page_range, file_content, start, end)
+
+    with EXTRACTION_STAGE.labels("pdf_text").time():
+        page_count = await run_in_pool(count_pages, file_content)
+        tasks = [
+            asyncio.ensure_future(extract_range(start, end))
+            for start, end in page_ranges(page_count, EXTRACT_WORKERS)
+        ]
+        try:
+            for next_range in asyncio.as_completed(tasks):
+                start, pages = await next_range
+                for offset, page in enumerate(pages):
+                    yield start + offset + 1, page
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def page_windows(page_numbers: Iterable[int], size: int) -> List[List[int]]:
+    """Group page numbers into runs of consecutive pages, at most size long"""
+    windows: List[List[int]] = []
+    for number in sorted(set(page_numbers)):
+        if windows and number == windows[-1][-1] + 1 and len(windows[-1]) < size:
+            windows[-1].append(number)
+        else:
+            windows.append([number])
+    return windows
+
+
+def ocr_image(image, live: LivePages) -> str:
+    """OCR one page image, then free it and its slot"""
+    try:
+        with OCR_PAGE.time():
+            return pytesseract.image_to_string(image)
+    finally:
+        image.close()
+        live.release()
+
+
+def ocr_page(number: int, image, live: LivePages, on_page: Optional[PageCallback]) -> str:
+    """ocr_image, reporting the page to on_page as soon as it is done"""
+    started = time.perf_counter()
+    text = ocr_image(image, live)
+    if on_page is not None:
+        on_page(number, text, time.perf_counter() - started)
+    return text
+
+
+@contextmanager
+def pdf_file(file_content: bytes) -> Iterator[str]:
+    """Path of a temp file holding the PDF, removed on exit
+
+    pdf2image only hands poppler a path (convert_from_bytes writes a temp
+    file on every call), so a document is written once and every window is
+    rendered from that one file.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(file_content)
+        yield path
+    finally:
+        os.unlink(path)
+
+
+def ocr_pages(
+    file_content: bytes,
+    page_numbers: Iterable[int],
+    on_page: Optional[PageCallback] = None,
+    stop: Optional[threading.Event] = None,
+) -> Dict[int, str]:
+    """OCR the given (1-based) pages of a PDF, returning text by page number
+
+    The PDF is written to one temp file for poppler to read, and its pages
+    are rendered from it OCR_WINDOW at a time, only once there is room for
+    them under OCR_MAX_LIVE_PAGES (a cap shared by all concurrent calls).
+    Each image is closed as soon as tesseract is done with it. on_page
+    (number, text, seconds) is called from the OCR threads as pages finish;
+    setting stop renders no further pages.
+    """
+    window_size = max(1, min(OCR_WINDOW, OCR_MAX_LIVE_PAGES))
+    live = _live_pages
+    pool = get_ocr_pool()
+    futures = {}
+    try:
+        with pdf_file(file_content) as pdf_path:
+            for window in page_windows(page_numbers, window_size):
+                if stop is not None and stop.is_set():
+                    break
+                live.acquire(len(window))
+                try:
+                    with EXTRACTION_STAGE.labels("pdf_render").time():
+                        images = convert_from_path(
+                            pdf_path, dpi=OCR_DPI, first_page=window[0], last_page=window[-1]
+                        )
+                except Exception:
+                    live.release(len(window))
+                    raise
+                for number, image in zip(window, images):
+                    futures[number] = (pool.submit(ocr_page, number, image, live, on_page), image)
+                # Fewer images than pages (e.g. a short PDF): give back the unused slots
+                if len(images) < len(window):
+                    live.release(len(window) - len(images))
+                del images
+        return {number: future.result() for number, (future, _) in futures.items()}
+    finally:
+        for future, image in futures.values():
+            # A page that never reached tesseract still holds its image and slot
+            if future.cancel():
+                image.close()
+                live.release()
+
+
+async def iter_ocr_pages(
+    file_content: bytes, page_numbers: Iterable[int]
+) -> AsyncIterator[Tuple[int, str, float]]:
+    """(page number, text, seconds) of each OCR'd page, in the order they finish
+
+    Stops rendering pages if the caller stops iterating, e.g. because the
+    client of a streaming response went away.
+    """
+    loop = asyncio.get_running_loop()
+    done: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def on_page(number: int, text: str, seconds: float):
+        loop.call_soon_threadsafe(done.put_nowait, (number, text, seconds))
+
+    with EXTRACTION_STAGE.labels("pdf_ocr").time():
+        task = asyncio.ensure_future(
+            run_in_threadpool(ocr_pages, file_content, list(page_numbers), on_page, stop)
+        )
+        try:
+            while not (task.done() and done.empty()):
+                waiter = asyncio.ensure_future(done.get())
+                await asyncio.wait({waiter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if waiter.done():
+                    yield waiter.result()
+                else:
+                    waiter.cancel()
+            # Raises if OCR failed
+            task.result()
+        finally:
+            stop.set()
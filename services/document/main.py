@@ -1,20 +1,40 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
 from pydantic import BaseModel
 import os
+import json
+import time
 import uuid
-from typing import Optional
-import PyPDF2
+from typing import AsyncIterator, List, Optional
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
 from docx import Document as DocxDocument
 from PIL import Image
 import pytesseract
-from pdf2image import convert_from_path
 import io
 from dotenv import load_dotenv
+from extraction import (
+    EXTRACTION_STAGE, OCR_PAGE, iter_ocr_pages, iter_pdf_pages, ocr_available, shutdown_pool,
+)
+from cache import cache_key, extraction_cache
 
 load_dotenv()
 
-app = FastAPI(title="Document Processing Service")
+# Largest accepted upload, matching the backend's limit
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# "hit" when a response was served from the extraction cache, else "miss"
+CACHE_HEADER = "X-Extraction-Cache"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    shutdown_pool()
+
+
+app = FastAPI(title="Document Processing Service", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,6 +44,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Metrics, served at /metrics in the Prometheus text format
+REQUEST_ID_HEADER = "X-Request-ID"
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "2"))
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request, by route template",
+    ["method", "route", "status"],
+)
+
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Time each request and echo its X-Request-ID (from the backend) back"""
+    rid = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers[REQUEST_ID_HEADER] = rid
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        REQUEST_LATENCY.labels(request.method, route, str(status)).observe(elapsed)
+        if elapsed >= SLOW_REQUEST_SECONDS:
+            print(f"Slow request {rid}: {request.method} {route} -> {status} in {elapsed:.3f}s")
+
 
 class ProcessResponse(BaseModel):
     id: str
@@ -32,57 +80,73 @@ class ProcessResponse(BaseModel):
     page_count: Optional[int] = None
 
 
-def extract_text_from_pdf(file_content: bytes, filename: str) -> tuple[str, int]:
-    """Extract text from PDF file"""
-    try:
-        pdf_file = io.BytesIO(file_content)
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text_content = []
-        page_count = len(pdf_reader.pages)
-        
-        for page in pdf_reader.pages:
-            text = page.extract_text()
-            if text.strip():
-                text_content.append(text)
-        
-        # If no text found, try OCR (if available)
-        if not text_content:
-            try:
-                # Save temporarily for OCR
-                temp_path = f"/tmp/{uuid.uuid4()}.pdf"
-                with open(temp_path, "wb") as f:
-                    f.write(file_content)
-                
-                try:
-                    images = convert_from_path(temp_path)
-                    ocr_text = []
-                    for image in images:
-                        text = pytesseract.image_to_string(image)
-                        ocr_text.append(text)
-                    text_content = ocr_text
-                except Exception as e:
-                    print(f"OCR failed (may not be available): {e}")
-                finally:
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
-            except Exception as e:
-                print(f"OCR not available: {e}")
-        
-        return "\n\n".join(text_content), page_count
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"PDF processing error: {str(e)}")
+PDF_TYPE = "application/pdf"
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+def document_type(file_type: str, filename: str) -> str:
+    """Normalized content type of an upload, or 400 if it is not supported"""
+    if file_type == PDF_TYPE or filename.lower().endswith(".pdf"):
+        return PDF_TYPE
+    if file_type == DOCX_TYPE or filename.lower().endswith(".docx"):
+        return DOCX_TYPE
+    if file_type.startswith("image/"):
+        return file_type
+    raise HTTPException(
+        status_code=400,
+        detail=f"Unsupported file type: {file_type}. Supported: PDF, DOCX, images"
+    )
+
+
+def page_record(number: int, text: str, method: str, seconds: float) -> dict:
+    return {"page": number, "text": text, "method": method, "seconds": round(seconds, 3)}
+
+
+async def pdf_page_records(file_content: bytes) -> AsyncIterator[dict]:
+    """One record per page of a PDF, yielded as each page is done
+
+    Each page uses its text layer unless that is too sparse for the page
+    size (a scan or a figure); only those pages are sent to OCR, once the
+    text layer of every page has been read.
+    """
+    sparse = {}
+    async for number, page in iter_pdf_pages(file_content):
+        if page.needs_ocr():
+            sparse[number] = page
+        else:
+            yield page_record(number, page.text, "text", page.seconds)
+    
+    if sparse:
+        ocr = iter_ocr_pages(file_content, sorted(sparse))
+        try:
+            async for number, text, seconds in ocr:
+                page = sparse.pop(number)
+                # Keep the text layer when OCR does not find more
+                if len(text.strip()) > len(page.text.strip()):
+                    yield page_record(number, text, "ocr", page.seconds + seconds)
+                else:
+                    yield page_record(number, page.text, "text", page.seconds + seconds)
+        except Exception as e:
+            print(f"OCR failed (may not be available): {e}")
+        finally:
+            await ocr.aclose()
+    
+    for number, page in sorted(sparse.items()):
+        # Wanted OCR but did not get it; keeps the result out of the cache
+        yield {**page_record(number, page.text, "text", page.seconds), "ocr_failed": True}
 
 
 def extract_text_from_docx(file_content: bytes) -> str:
     """Extract text from DOCX file"""
     try:
         docx_file = io.BytesIO(file_content)
-        doc = DocxDocument(docx_file)
         text_content = []
         
-        for paragraph in doc.paragraphs:
-            if paragraph.text.strip():
-                text_content.append(paragraph.text)
+        with EXTRACTION_STAGE.labels("docx").time():
+            doc = DocxDocument(docx_file)
+            for paragraph in doc.paragraphs:
+                if paragraph.text.strip():
+                    text_content.append(paragraph.text)
         
         return "\n\n".join(text_content)
     except Exception as e:
@@ -94,7 +158,8 @@ def extract_text_from_image(file_content: bytes) -> str:
     try:
         image = Image.open(io.BytesIO(file_content))
         try:
-            text = pytesseract.image_to_string(image)
+            with EXTRACTION_STAGE.labels("image_ocr").time(), OCR_PAGE.time():
+                text = pytesseract.image_to_string(image)
             return text
         except Exception as e:
             # OCR not available, return empty string
@@ -109,35 +174,74 @@ def extract_text_from_image(file_content: bytes) -> str:
         raise HTTPException(status_code=500, detail=f"Image processing error: {str(e)}")
 
 
+async def page_records(file_content: bytes, file_type: str) -> AsyncIterator[dict]:
+    """Per-page records of any supported document; DOCX and images are one page"""
+    if file_type == PDF_TYPE:
+        async for record in pdf_page_records(file_content):
+            yield record
+        return
+    started = time.perf_counter()
+    if file_type == DOCX_TYPE:
+        text = await run_in_threadpool(extract_text_from_docx, file_content)
+        yield page_record(1, text, "docx", time.perf_counter() - started)
+    else:
+        text = await run_in_threadpool(extract_text_from_image, file_content)
+        yield page_record(1, text, "ocr", time.perf_counter() - started)
+
+
+async def extract_pages(file_content: bytes, file_type: str) -> List[dict]:
+    """Per-page records of a document, in page order"""
+    try:
+        records = [record async for record in page_records(file_content, file_type)]
+    except HTTPException:
+        raise
+    except Exception as e:
+        kind = "PDF processing" if file_type == PDF_TYPE else "Processing"
+        raise HTTPException(status_code=500, detail=f"{kind} error: {str(e)}")
+    return sorted(records, key=lambda record: record["page"])
+
+
+def cacheable(pages: List[dict]) -> bool:
+    """Only complete extractions that found text are worth keeping
+
+    Pages that missed OCR make a result incomplete only where OCR is
+    installed (and so may work next time); without it they are as good as
+    this deployment gets, and the cache key records that OCR was missing.
+    """
+    if not any(page["text"].strip() for page in pages):
+        return False
+    return not ocr_available() or not any(page.get("ocr_failed") for page in pages)
+
+
+def join_pages(pages: List[dict]) -> str:
+    return "\n\n".join(page["text"] for page in pages if page["text"].strip())
+
+
 @app.post("/process", response_model=ProcessResponse)
-async def process_document(file: UploadFile = File(...)):
+async def process_document(response: Response, file: UploadFile = File(...)):
     """Process uploaded document and extract text"""
+    size = getattr(file, "size", None)
+    if size is not None and size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_BYTES} bytes)")
+    
     try:
-        file_content = await file.read()
+        with EXTRACTION_STAGE.labels("read").time():
+            file_content = await file.read()
         file_type = file.content_type or ""
         filename = file.filename or ""
         
-        # Determine file type and extract text
-        text_content = ""
-        page_count = None
+        # Determine file type, then extract text unless this file was seen before
+        file_type = document_type(file_type, filename)
+        key = await run_in_threadpool(cache_key, file_content, file_type)
+        pages = await run_in_threadpool(extraction_cache.get, key)
+        response.headers[CACHE_HEADER] = "miss" if pages is None else "hit"
+        if pages is None:
+            pages = await extract_pages(file_content, file_type)
+            if cacheable(pages):
+                await run_in_threadpool(extraction_cache.put, key, pages)
         
-        if file_type == "application/pdf" or filename.lower().endswith(".pdf"):
-            text_content, page_count = extract_text_from_pdf(file_content, filename)
-            file_type = "application/pdf"
-        elif (
-            file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-            or filename.lower().endswith(".docx")
-        ):
-            text_content = extract_text_from_docx(file_content)
-            file_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        elif file_type.startswith("image/"):
-            text_content = extract_text_from_image(file_content)
-            file_type = file_type
-        else:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Unsupported file type: {file_type}. Supported: PDF, DOCX, images"
-            )
+        text_content = join_pages(pages)
+        page_count = len(pages) if file_type == PDF_TYPE else None
         
         if not text_content.strip():
             raise HTTPException(
@@ -157,6 +261,76 @@ async def process_document(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
 
 
+@app.post("/process/stream")
+async def process_document_stream(file: UploadFile = File(...)):
+    """Process uploaded document, streaming the text as NDJSON page by page
+
+    Emits {"page", "text", "method", "seconds"} for each page as soon as it
+    is extracted (so not necessarily in page order; method is "text",
+    "ocr" or "docx"), then {"done": true, "id", "file_type", "page_count",
+    "ocr_pages", "cached", "seconds"}. Failures once streaming has started
+    end the stream with {"error": ...} instead. Files already in the
+    extraction cache are replayed from it in page order.
+    """
+    size = getattr(file, "size", None)
+    if size is not None and size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_BYTES} bytes)")
+    
+    file_type = document_type(file.content_type or "", file.filename or "")
+    with EXTRACTION_STAGE.labels("read").time():
+        file_content = await file.read()
+    key = await run_in_threadpool(cache_key, file_content, file_type)
+    cached = await run_in_threadpool(extraction_cache.get, key)
+    
+    async def replay(pages: List[dict]) -> AsyncIterator[dict]:
+        for page in pages:
+            yield page
+    
+    async def lines():
+        started = time.perf_counter()
+        pages = []
+        records = page_records(file_content, file_type) if cached is None else replay(cached)
+        try:
+            async for record in records:
+                pages.append(record)
+                yield json.dumps(record) + "\n"
+        except HTTPException as e:
+            yield json.dumps({"error": e.detail}) + "\n"
+            return
+        except Exception as e:
+            yield json.dumps({"error": f"Processing error: {str(e)}"}) + "\n"
+            return
+        finally:
+            await records.aclose()
+        if not any(page["text"].strip() for page in pages):
+            yield json.dumps({"error": "No text content could be extracted from the document"}) + "\n"
+            return
+        if cached is None and cacheable(pages):
+            pages.sort(key=lambda page: page["page"])
+            await run_in_threadpool(extraction_cache.put, key, pages)
+        yield json.dumps({
+            "done": True,
+            "id": str(uuid.uuid4()),
+            "file_type": file_type,
+            "page_count": len(pages) if file_type == PDF_TYPE else None,
+            "ocr_pages": sum(page["method"] == "ocr" for page in pages),
+            "cached": cached is not None,
+            "seconds": round(time.perf_counter() - started, 3),
+        }) + "\n"
+    
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={CACHE_HEADER: "miss" if cached is None else "hit"},
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/health")
 async def health():
     return {"status": "healthy", "service": "document-processing"}